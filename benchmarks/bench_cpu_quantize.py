@@ -0,0 +1,75 @@
+'''
+int8の動的量子化(--cpu-quantize)による生成の速度(tokens/sec)と品質の変化を，同じモデルのfp32と比べる
+usage : python benchmarks/bench_cpu_quantize.py [DATA_DIR] --path [checkpoint] --keywords [キーワードのファイル] \
+            --cpu --nbest 5 --intra-op-threads 4 --inter-op-threads 1
+
+--keywordsには学習に使っていないキーワードを1行に1つ(`猫[SEP]雨`の形式で)書いておく．
+品質の変化は1位の候補のスコア(底2)の差の平均と，1位の候補がfp32と一致する割合で見る
+'''
+import copy
+import math
+import os
+import sys
+import time
+
+from logzero import logger
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "fairseq_src", "src"))
+from fairseq import options  # noqa: E402
+from keyword_generator import KeywordGenerator, add_cpu_args  # noqa: E402
+
+
+def parse_args():
+    parser = add_cpu_args(options.get_generation_parser(interactive=True))
+    group = parser.add_argument_group('Benchmark')
+    group.add_argument('--keywords', required=True, help='held-out keywords, one query per line')
+    args = options.parse_args_and_arch(parser)
+    return args
+
+
+def run(keyword_generator, queries):
+    '''
+    生成した候補のトークン数/秒，1位の候補のスコアと文字列を返す
+    '''
+    nbest = keyword_generator.args.nbest
+    start = time.perf_counter()
+    results = keyword_generator.translate(queries)
+    elapsed = time.perf_counter() - start
+    n_tokens = sum(hypo['tokens'].numel() for _, _, hypos in results for hypo in hypos[:nbest])
+    scores = [float(hypos[0]['score']) / math.log(2) for _, _, hypos in results]
+    tops = [keyword_generator.tgt_dict.string(hypos[0]['tokens']) for _, _, hypos in results]
+    return n_tokens / elapsed, scores, tops
+
+
+def main():
+    args = parse_args()
+    with open(args.keywords, 'r') as fin:
+        queries = [line.strip() for line in fin if line.strip()]
+    if args.max_tokens is None and args.max_sentences is None:
+        args.max_sentences = len(queries)
+
+    fp32_args = copy.copy(args)
+    fp32_args.cpu_quantize = False
+    fp32 = KeywordGenerator(fp32_args)
+    int8_args = copy.copy(args)
+    int8_args.cpu_quantize = True
+    int8 = KeywordGenerator(int8_args, models=copy.deepcopy(fp32.models))
+
+    # 1回目は初期化の時間が入るので捨てる
+    run(fp32, queries[:1])
+    run(int8, queries[:1])
+    fp32_speed, fp32_scores, fp32_tops = run(fp32, queries)
+    int8_speed, int8_scores, int8_tops = run(int8, queries)
+
+    drift = sum(q - f for q, f in zip(int8_scores, fp32_scores)) / len(queries)
+    agreement = sum(q == f for q, f in zip(int8_tops, fp32_tops)) / len(queries)
+    logger.info(f"{len(queries)} queries, intra-op threads {args.intra_op_threads}, "
+                f"inter-op threads {args.inter_op_threads}")
+    logger.info(f"fp32 : {fp32_speed:,.0f} tokens/sec")
+    logger.info(f"int8 : {int8_speed:,.0f} tokens/sec ({int8_speed / fp32_speed:.2f}x)")
+    logger.info(f"mean top-1 score difference (int8 - fp32, base 2): {drift:+.4f}")
+    logger.info(f"top-1 agreement with fp32: {agreement:.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+'''
+EmoticonFilter._has_emoticonの速度を，1文字ずつunicodedata.nameを引く以前の実装と比較する
+usage : python benchmarks/bench_emoticon_filter.py --texts 100000
+'''
+import argparse
+import os
+import random
+import re
+import sys
+import time
+import unicodedata
+
+from logzero import logger
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from filtering_type import EmoticonFilter  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--texts", type=int, default=100000,
+                        help="number of synthetic tweets")
+    parser.add_argument("--seed", type=int, default=1, help="seed")
+    args = parser.parse_args()
+    return args
+
+
+class ReferenceEmoticonFilter(EmoticonFilter):
+    """1文字ずつunicodedata.nameを引く以前の実装"""
+
+    def __init__(self):
+        super(ReferenceEmoticonFilter, self).__init__()
+        self._candidate_reg = re.compile(r"[\W_a-zA-Z]+")
+
+    def _has_japanese_char(self, text):
+        for ch in text:
+            try:
+                name = unicodedata.name(ch)
+                if any(n in name for n in self._japanese_names) and not any(c == ch for c in self._face_letter):
+                    return True
+            except:
+                pass
+
+
+WORDS = ["今日は", "いい天気", "ですね", "！", "？", "、", "。", "www", "Twitter", "(笑)",
+         "ラーメン", "食べたい", "#", "ｗｗｗ", "（今日）", "PV", " ", "@user", "😂", "東京"]
+EMOTICONS = ["（＾Ｏ＾）", "(ﾟдﾟ)", "( ′～‵)", "^o^",
+             "(灬ºωº灬)", "(ノД｀)", "(๑˃̵ᴗ˂̵)و"]
+
+
+def make_text():
+    parts = [random.choice(WORDS) for _ in range(random.randint(3, 20))]
+    if random.random() < 0.1:
+        parts.append(random.choice(EMOTICONS))
+    return "".join(parts)
+
+
+def bench(filtering, texts):
+    start = time.perf_counter()
+    results = [bool(filtering._has_emoticon(text)) for text in texts]
+    return len(texts) / (time.perf_counter() - start), results
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    texts = [make_text() for _ in range(args.texts)]
+    reference, fast = ReferenceEmoticonFilter(), EmoticonFilter()
+    # 文字クラスの構築は初回だけなので計測から除く
+    fast._has_emoticon("(テスト)")
+
+    before, expected = bench(reference, texts)
+    after, results = bench(fast, texts)
+    assert results == expected, "results differ from the reference implementation"
+    logger.info(f"{len(texts)} texts, {sum(results)} with emoticons")
+    logger.info(f"reference : {before:,.0f} texts/sec")
+    logger.info(f"current   : {after:,.0f} texts/sec")
+    logger.info(f"speedup: {after / before:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
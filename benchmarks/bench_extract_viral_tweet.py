@@ -0,0 +1,78 @@
+'''
+extract_viral_tweet.extractの速度(lines/sec)をprefilterの有無で比較する
+usage : python benchmarks/bench_extract_viral_tweet.py --lines 200000
+'''
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import time
+
+from logzero import logger
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import extract_viral_tweet  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, default=200000,
+                        help="number of synthetic tweets")
+    parser.add_argument("--viral_ratio", type=float, default=0.01,
+                        help="ratio of tweets with enough favorites")
+    parser.add_argument("--seed", type=int, default=1, help="seed")
+    args = parser.parse_args()
+    return args
+
+
+def make_tweet(i, viral):
+    '''
+    クロールデータに近い大きさ(数KB)の擬似ツイートを作る
+    '''
+    user = {"id": i, "screen_name": f"user{i}", "verified": random.random() < 0.05,
+            "description": "プロフィール" * 20, "followers_count": random.randint(0, 10 ** 5),
+            "friends_count": random.randint(0, 10 ** 3), "favourites_count": random.randint(0, 10 ** 5),
+            "profile_image_url": "http://pbs.twimg.com/profile_images/0/x.jpg"}
+    tweet = {"created_at": "Tue Oct 01 00:00:00 +0000 2019", "id": i, "id_str": str(i),
+             "text": "今日はいい天気ですね" * random.randint(1, 10), "source": "<a>Twitter for iPhone</a>",
+             "user": user, "entities": {"hashtags": [], "urls": [], "user_mentions": []},
+             "retweet_count": random.randint(1, 10 ** 4) if viral else random.randint(0, 3),
+             "favorite_count": random.randint(500, 10 ** 5) if viral else random.randint(0, 30),
+             "lang": "ja"}
+    if random.random() < 0.3:
+        tweet["retweeted_status"] = dict(tweet, user=dict(user, verified=True),
+                                         retweet_count=random.randint(0, 10 ** 4),
+                                         favorite_count=random.randint(0, 10 ** 4))
+        tweet["favorite_count"] = 0
+    return json.dumps(tweet, ensure_ascii=False, separators=(",", ":"))
+
+
+def run(lines, no_prefilter):
+    args = argparse.Namespace(exclude_verified=True, exclude_urls=True, favorite_count=500,
+                              retweet_count=1, no_prefilter=no_prefilter, fields=None)
+    fo = io.BytesIO()
+    start = time.perf_counter()
+    n_read, n_kept = extract_viral_tweet.extract(lines, fo, args)
+    elapsed = time.perf_counter() - start
+    return n_read / elapsed, n_kept, fo.getvalue()
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    lines = [make_tweet(i, random.random() < args.viral_ratio).encode("utf-8")
+             for i in range(args.lines)]
+    logger.info(f"{len(lines)} lines, {sum(map(len, lines)) / len(lines):.0f} bytes/line")
+
+    before, kept_before, out_before = run(lines, no_prefilter=True)
+    after, kept_after, out_after = run(lines, no_prefilter=False)
+    assert out_before == out_after, "prefilter changed the output"
+    logger.info(f"json.loads only : {before:,.0f} lines/sec (kept {kept_before})")
+    logger.info(f"with prefilter  : {after:,.0f} lines/sec (kept {kept_after})")
+    logger.info(f"speedup: {after / before:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+'''
+生成用モデルの起動時間と最大メモリ使用量を，checkpointから読み込む場合(interactive.shと同じ)と
+export_generator.pyで書き出したものを読み込む場合で比較する．それぞれ別のプロセスで計測する
+usage : python benchmarks/bench_generator_startup.py [DATA_DIR] --path [checkpoint] --artifact [export_dir] --repeat 3
+'''
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from logzero import logger
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "fairseq_src", "src")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_dir", help="DATA_DIR of interactive.sh")
+    parser.add_argument("--path", required=True, help="checkpoint (e.g. checkpoint_best.pt)")
+    parser.add_argument("--artifact", required=True, help="directory written by export_generator.py")
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs for each mode")
+    parser.add_argument("--child", choices=["checkpoint", "artifact"], default=None,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    return args
+
+
+def run_child(args):
+    '''
+    モデルを読み込んで最初の生成を終えるまでの時間と最大RSSを標準出力にjsonで書く
+    '''
+    start = time.perf_counter()
+    sys.path.insert(0, SRC_DIR)
+    from fairseq import options
+    from keyword_generator import KeywordGenerator, add_artifact_args
+
+    parser = add_artifact_args(options.get_generation_parser(interactive=True))
+    common = ["--source-lang", "source", "--target-lang", "target", "--cpu", "--nbest", "5"]
+    if args.child == "checkpoint":
+        input_args = [args.data_dir, "--path", args.path] + common
+    else:
+        input_args = [args.artifact, "--generator-artifact", args.artifact] + common
+    keyword_generator = KeywordGenerator(options.parse_args_and_arch(parser, input_args))
+    loaded = time.perf_counter()
+    keyword_generator.generate(["猫[SEP]雨"])
+    generated = time.perf_counter()
+    print(json.dumps({"load_seconds": loaded - start, "first_seconds": generated - start,
+                      "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}))
+
+
+def measure(mode):
+    command = [sys.executable, os.path.abspath(__file__), "--child", mode] + sys.argv[1:]
+    output = subprocess.run(command, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    args = parse_args()
+    if args.child:
+        run_child(args)
+        return
+
+    for mode in ["checkpoint", "artifact"]:
+        runs = [measure(mode) for _ in range(args.repeat)]
+        best = min(runs, key=lambda run: run["first_seconds"])
+        logger.info(f"{mode:10s}: load {best['load_seconds']:.2f}s, first result {best['first_seconds']:.2f}s, "
+                    f"max rss {best['max_rss_mb']:.0f}MB (best of {args.repeat})")
+
+
+if __name__ == "__main__":
+    main()
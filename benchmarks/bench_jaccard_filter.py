@@ -0,0 +1,79 @@
+'''
+JaccardFilter.is_passの速度を以前の実装と比較し，結果が同じことを確かめる
+usage : python benchmarks/bench_jaccard_filter.py --chains 1000000
+
+MeCabの解析時間を除くため，空白区切りのテキストをstr.splitでトークナイズする
+'''
+import argparse
+import os
+import random
+import sys
+import time
+
+from logzero import logger
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from filtering_type import JaccardFilter  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chains", type=int, default=1000000,
+                        help="number of synthetic chains")
+    parser.add_argument("--seed", type=int, default=1, help="seed")
+    args = parser.parse_args()
+    return args
+
+
+def reference_is_pass(text_chain, tokenizer, threshold):
+    """JaccardFilter.is_passの以前の実装(1つ前のテキストもトークナイズし直す)"""
+    for i in range(len(text_chain)):
+        words = tokenizer(text_chain[i])
+        if len(set(words)) / len(words) < 0.5:
+            return False
+        if i != 0:
+            set1 = set(tokenizer(text_chain[i - 1]))
+            set2 = set(words)
+            score = len(set1 & set2) / len(set1 | set2)
+            if score >= threshold:
+                return False
+    return True
+
+
+def make_chain(vocab):
+    chain = []
+    for _ in range(random.randint(1, 3)):
+        # 同じ単語の繰り返しや，1つ前とほぼ同じテキストも混ぜる
+        words = vocab[:random.randint(3, 10)] if random.random() < 0.1 else vocab
+        if chain and random.random() < 0.1:
+            text = chain[-1] + " " + random.choice(words)
+        else:
+            text = " ".join(random.choice(words) for _ in range(random.randint(6, 29)))
+        chain.append(text)
+    return chain
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    vocab = [f"w{i}" for i in range(2000)]
+    chains = [make_chain(vocab) for _ in range(args.chains)]
+    filtering = JaccardFilter()
+    filtering.tokenizer = str.split
+
+    start = time.perf_counter()
+    expected = [reference_is_pass(chain, str.split, filtering.threshold) for chain in chains]
+    reference = len(chains) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    results = [filtering.is_pass(chain) for chain in chains]
+    per_chain = len(chains) / (time.perf_counter() - start)
+    assert results == expected, "is_pass differs from the reference implementation"
+
+    logger.info(f"{len(chains)} chains, {sum(results)} passed")
+    logger.info(f"previous is_pass: {reference:,.0f} chains/sec")
+    logger.info(f"is_pass         : {per_chain:,.0f} chains/sec")
+
+
+if __name__ == "__main__":
+    main()
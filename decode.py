@@ -1,14 +1,18 @@
 '''
 extract_viral_tweet.pyで収集したツイッターデータを閲覧するコード
 usage : cat [tweet data path] |python decode.py |less
+        python decode.py [tweet data path (.jsonl, .gz, .zst, .parquet or .npz)] |less
 '''
 import sys
 import json
 
+from extract_viral_tweet import read_records
+
+FIELDS = ["text", "retweet_count", "favorite_count"]
+
 
 def main(fi):
-    for line in fi:
-        data = json.loads(line)
+    for data in fi:
         print(data["text"], "\nret:", data["retweet_count"],
               "\nfav:", data["favorite_count"])
         print("-----------")
@@ -16,4 +20,7 @@ def main(fi):
 
 
 if __name__ == "__main__":
-    main(sys.stdin)
+    if len(sys.argv) > 1:
+        main(read_records(sys.argv[1], FIELDS))
+    else:
+        main(map(json.loads, sys.stdin))
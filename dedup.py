@@ -0,0 +1,219 @@
+'''
+preprocess.pyの出力から重複・ほぼ重複したツイートを除く
+usage : python dedup.py -i [preprocess.pyの出力] -o [出力ファイル]
+
+文字n-gramのMinHashをNumPyでまとめて計算し，LSHで候補を絞ってから
+署名の一致率(Jaccard係数の推定値)で確かめる．クラスタごとに最初に出てきたツイートだけを残す．
+署名などはディスク上に置くので，メモリ使用量はツイート数に比例する数個の整数配列に抑えられる
+'''
+import argparse
+import json
+import logging
+import os
+import tempfile
+from os import path
+
+import numpy as np
+from logzero import logger
+
+from extract_viral_tweet import read_lines
+from parallel import iter_chunks
+
+logger.setLevel(logging.INFO)
+
+# MinHashのハッシュ関数 (a * x + b) mod PRIME に使う素数 (< 2**32)
+PRIME = np.uint64(4294967291)
+# 文字n-gramのローリングハッシュの基数
+BASE = np.uint64(1000003)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-i', '--input', type=path.abspath, help='input file path (output of preprocess.py)')
+    parser.add_argument(
+        '-o', '--output', type=path.abspath, help='output file path')
+    parser.add_argument(
+        '--shingle', type=int, default=4, help='character n-gram size')
+    parser.add_argument(
+        '--num_perm', type=int, default=64, help='number of MinHash permutations')
+    parser.add_argument(
+        '--bands', type=int, default=16, help='number of LSH bands (must divide --num_perm)')
+    parser.add_argument(
+        '--threshold', type=float, default=0.8,
+        help='estimated Jaccard similarity to treat two tweets as duplicates')
+    parser.add_argument(
+        '--batch_size', type=int, default=2000, help='number of tweets hashed at once')
+    parser.add_argument(
+        '--tmp_dir', type=path.abspath, default=None, help='directory for temporary signature files')
+    parser.add_argument(
+        '--seed', type=int, default=1, help='seed of the hash functions')
+    args = parser.parse_args()
+    if args.num_perm % args.bands != 0:
+        parser.error("--bands must divide --num_perm")
+    return args
+
+
+class MinHasher(object):
+    """文字n-gramのMinHash署名とLSHのバンドのキーを計算する"""
+
+    def __init__(self, shingle=4, num_perm=64, bands=16, seed=1):
+        rng = np.random.RandomState(seed)
+        self.shingle = shingle
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        # a < 2**31, x < 2**32 なので a * x + b はuint64に収まる
+        self._a = rng.randint(1, 2 ** 31, size=num_perm).astype(np.uint64)
+        self._b = rng.randint(0, 2 ** 32, size=num_perm).astype(np.uint64)
+        self._band_mult = (rng.randint(1, 2 ** 62, size=self.rows).astype(np.uint64)
+                           * np.uint64(2) + np.uint64(1))
+
+    def shingle_hashes(self, texts):
+        """
+        各テキストの文字n-gramのハッシュ値(< 2**32)を連結したものと，テキストごとの開始位置を返す
+
+        n文字に満たないテキストはテキスト全体を1つのn-gramとして扱う
+        """
+        k = self.shingle
+        pad = np.zeros(k, dtype=np.uint32)
+        arrays, starts, counts = [], [], []
+        offset = 0
+        for text in texts:
+            codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+            # テキストの間にk個の0を挟み，n-gramが隣のテキストにまたがらないようにする
+            arrays.append(codes)
+            arrays.append(pad)
+            starts.append(offset)
+            counts.append(max(1, len(codes) - k + 1))
+            offset += len(codes) + k
+        codes = np.concatenate(arrays).astype(np.uint64)
+
+        n = len(codes) - k + 1
+        h = np.zeros(n, dtype=np.uint64)
+        for j in range(k):
+            h = h * BASE + codes[j:j + n]
+        h = (h * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(32)
+
+        starts = np.asarray(starts, dtype=np.int64)
+        counts = np.asarray(counts, dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        index = np.repeat(starts - offsets, counts) + np.arange(counts.sum())
+        return h[index], offsets
+
+    def signatures(self, texts):
+        """(テキスト数, num_perm)のMinHash署名(uint32)を返す"""
+        if not texts:
+            return np.zeros((0, self.num_perm), dtype=np.uint32)
+        h, offsets = self.shingle_hashes(texts)
+        values = (h[:, None] * self._a[None, :] + self._b[None, :]) % PRIME
+        return np.minimum.reduceat(values, offsets, axis=0).astype(np.uint32)
+
+    def band_keys(self, signatures):
+        """(テキスト数, bands)のLSHのバンドのキー(uint64)を返す"""
+        sig = signatures.astype(np.uint64).reshape(
+            len(signatures), self.bands, self.rows)
+        return (sig * self._band_mult[None, None, :]).sum(axis=2, dtype=np.uint64)
+
+
+def candidate_pairs(keys):
+    """
+    同じバンドのキーを持つテキストの組を(後のテキスト, そのキーを最初に持つテキスト)として返す
+    """
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    is_start = np.ones(len(keys), dtype=bool)
+    is_start[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    run_first = order[np.flatnonzero(is_start)][np.cumsum(is_start) - 1]
+    dup = order != run_first
+    return order[dup], run_first[dup]
+
+
+def connected_min_labels(n, u, v):
+    """
+    u[i]とv[i]をつないだグラフの連結成分ごとに，成分内で最小の番号を返す
+    """
+    labels = np.arange(n)
+    if len(u) == 0:
+        return labels
+    while True:
+        m = np.minimum(labels[u], labels[v])
+        new = labels.copy()
+        np.minimum.at(new, u, m)
+        np.minimum.at(new, v, m)
+        new = new[new]
+        if np.array_equal(new, labels):
+            return labels
+        labels = new
+
+
+def find_duplicates(texts, hasher, threshold=0.8, batch_size=2000, tmp_dir=None):
+    """
+    textsのうち，より前に出てきたテキストとほぼ重複しているものにTrueを立てた配列を返す
+    """
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as work_dir:
+        sig_path = os.path.join(work_dir, "signatures.u32")
+        key_path = os.path.join(work_dir, "band_keys.u64")
+        n = 0
+        with open(sig_path, 'wb') as fsig, open(key_path, 'wb') as fkey:
+            for batch in iter_chunks(texts, batch_size):
+                sig = hasher.signatures(batch)
+                fsig.write(sig.tobytes())
+                fkey.write(hasher.band_keys(sig).tobytes())
+                n += len(batch)
+        if n == 0:
+            return np.zeros(0, dtype=bool)
+
+        signatures = np.memmap(sig_path, dtype=np.uint32, mode='r',
+                               shape=(n, hasher.num_perm))
+        band_keys = np.memmap(key_path, dtype=np.uint64, mode='r',
+                              shape=(n, hasher.bands))
+        edges_u, edges_v = [], []
+        for band in range(hasher.bands):
+            u, v = candidate_pairs(np.array(band_keys[:, band]))
+            # LSHの候補を署名の一致率で確かめる
+            for start in range(0, len(u), batch_size):
+                bu, bv = u[start:start + batch_size], v[start:start + batch_size]
+                sim = (signatures[bu] == signatures[bv]).mean(axis=1)
+                keep = sim >= threshold
+                edges_u.append(bu[keep])
+                edges_v.append(bv[keep])
+        u = np.concatenate(edges_u) if edges_u else np.zeros(0, dtype=np.int64)
+        v = np.concatenate(edges_v) if edges_v else np.zeros(0, dtype=np.int64)
+        labels = connected_min_labels(n, u, v)
+        del signatures, band_keys
+    return labels != np.arange(n)
+
+
+def test_find_duplicates():
+    texts = ["今日はいい天気ですね", "今日はいい天気ですね！", "明日は雨が降るらしい",
+             "今日はいい天気ですね", "ラーメン食べたい", "ラーメンが食べたい"]
+    hasher = MinHasher(shingle=2, num_perm=64, bands=32)
+    is_dup = find_duplicates(texts, hasher, threshold=0.6, batch_size=2)
+    assert is_dup.tolist() == [False, True, False, True, False, True], is_dup
+
+
+def tweet_text(line) -> str:
+    # preprocess.pyの出力はトークンを空白でつないでいるので元の文字列に戻す
+    return "".join(json.loads(line)["tweet"].split())
+
+
+def main():
+    args = parse_args()
+    logger.info(args)
+
+    hasher = MinHasher(args.shingle, args.num_perm, args.bands, args.seed)
+    texts = (tweet_text(line) for line in read_lines(args.input))
+    is_dup = find_duplicates(texts, hasher, args.threshold,
+                             args.batch_size, args.tmp_dir)
+
+    with open(args.output, 'wb') as fout:
+        for line, dup in zip(read_lines(args.input), is_dup):
+            if not dup:
+                fout.write(line + b"\n")
+    logger.info(
+        f"tweets: {len(is_dup)}\nduplicates: {int(is_dup.sum())}\nkept: {int((~is_dup).sum())}")
+
+
+if __name__ == '__main__':
+    main()
@@ -2,22 +2,75 @@
     extract viral tweet.
 '''
 import sys
+import os
 import json
 import argparse
 import re
+import glob
+import gzip
+import hashlib
+import mmap
+import shutil
+import tempfile
+from multiprocessing import Pool
+from typing import List
+
+from logzero import logger
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# 入力を読み込むブロックの大きさ
+BLOCK_SIZE = 1 << 22
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+# 列指向で書き出す出力の拡張子
+COLUMNAR_SUFFIXES = (".parquet", ".npz")
+# npzでJSON文字列として保存した列の名前を持つ配列
+NPZ_JSON_FIELDS = "__json_fields__"
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
+    parser.add_argument("inputs", nargs="*",
+                        help="input files (.gz, .zst or plain) or glob patterns. read from stdin if omitted")
     parser.add_argument("--exclude_verified",  default=False,
                         action='store_true', help="")
     parser.add_argument("--favorite_count", type=int, default=500, help="")
     parser.add_argument("--retweet_count", type=int, default=1, help="")
     parser.add_argument("--exclude_urls",  default=False,
                         action='store_true', help="")
-    parser.add_argument("--output", help='output file path')
+    parser.add_argument("--output",
+                        help='output file path. compressed if it ends with .gz or .zst, '
+                        'columnar if it ends with .parquet or .npz')
+    parser.add_argument("--fields", type=lambda x: x.split(","), default=None,
+                        help="comma separated fields to keep (e.g. text,retweet_count,favorite_count). "
+                        "nested fields are joined with '.' (e.g. user.screen_name)")
+    parser.add_argument("--mmap", default=False, action='store_true',
+                        help="memory-map uncompressed input files")
+    parser.add_argument("--no_prefilter", default=False, action='store_true',
+                        help="disable the fast-reject scan before json.loads")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="number of worker processes (one input file per task)")
+    parser.add_argument("--shard_dir", default=None,
+                        help="directory for per-file shards and manifest.json (default: OUTPUT.shards)")
+    parser.add_argument("--force", default=False, action='store_true',
+                        help="ignore the manifest and process all inputs again")
     # parser.add_argument("--friend_ratio", type=int, default=1000000, help="")
     args = parser.parse_args()
+    if args.output.endswith(COLUMNAR_SUFFIXES) and not args.fields:
+        parser.error("--fields is required for columnar output")
     return args
 
 
@@ -29,33 +82,397 @@ def is_include_url(text):
         return False
 
 
+_favorite_count_reg = re.compile(rb'"favorite_count":\s*(\d+)')
+_retweet_count_reg = re.compile(rb'"retweet_count":\s*(\d+)')
+
+
+def may_be_viral(line, args) -> bool:
+    '''
+    json.loadsせずに，いいね数とリツイート数が閾値に届かない行をはじく
+
+    リツイート元や引用元のツイートも同じキーを持つため，行中の最大値で判定する．
+    Falseの行は必ずis_viralでもFalseになるので，出力は変わらない
+    '''
+    if max(map(int, _favorite_count_reg.findall(line)), default=-1) < args.favorite_count:
+        return False
+    if max(map(int, _retweet_count_reg.findall(line)), default=-1) < args.retweet_count:
+        return False
+    return True
+
+
+def is_viral(data, args) -> bool:
+    '''
+    フィルタの条件を全て満たすツイートの場合はTrueを返す
+    '''
+    # 公式アカウントを除外
+    if args.exclude_verified:
+        if data["user"]["verified"] is True:
+            return False
+
+    # followerがfolloingのx倍いる人のツイートを除外
+    # if args.friend_ratio * data["user"]["friends_count"] < data["user"]["followers_count"]:
+    #     return False
+
+    # いいねがx以下のツイートを除外
+    if data["favorite_count"] < args.favorite_count:
+        return False
+    # リツイートがx以下のツイートを除外
+    if data["retweet_count"] < args.retweet_count:
+        return False
+    # urlが貼られているツイートは除外
+    if args.exclude_urls:
+        if is_include_url(data["text"]):
+            return False
+    return True
+
+
+def _check_zstandard():
+    if zstandard is None:
+        raise ImportError(
+            "zstandard is required for .zst files. Run `pip install zstandard`")
+
+
+def open_input(path):
+    '''
+    拡張子に応じて.gz，.zst，非圧縮のファイルをバイナリで開く
+    '''
+    if path.endswith(".gz"):
+        return gzip.open(path, 'rb')
+    if path.endswith(".zst"):
+        _check_zstandard()
+        return zstandard.ZstdDecompressor().stream_reader(
+            open(path, 'rb'), read_across_frames=True, closefd=True)
+    return open(path, 'rb')
+
+
+def open_output(path):
+    '''
+    拡張子に応じて.gz，.zst，非圧縮のファイルをバイナリの書き込みで開く
+    '''
+    if path.endswith(".gz"):
+        return gzip.open(path, 'wb', compresslevel=GZIP_LEVEL)
+    if path.endswith(".zst"):
+        _check_zstandard()
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(
+            open(path, 'wb'), closefd=True)
+    return open(path, 'wb')
+
+
+def iter_lines(fi, block_size=BLOCK_SIZE):
+    '''
+    バイナリのファイルをblock_sizeずつ読み込み，行(bytes)に分割して返す．空行は飛ばす
+    '''
+    rest = b""
+    while True:
+        block = fi.read(block_size)
+        if not block:
+            break
+        lines = (rest + block).split(b"\n")
+        rest = lines.pop()
+        for line in lines:
+            if line:
+                yield line
+    if rest:
+        yield rest
+
+
+def iter_mmap_lines(path):
+    '''
+    非圧縮のファイルをmmapし，行(bytes)に分割して返す．空行は飛ばす
+    '''
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = 0
+            size = len(mm)
+            while start < size:
+                end = mm.find(b"\n", start)
+                if end < 0:
+                    end = size
+                if end > start:
+                    yield mm[start:end]
+                start = end + 1
+
+
+def read_lines(path, use_mmap=False):
+    '''
+    入力ファイルの各行(bytes)を返す
+    '''
+    if use_mmap and not path.endswith((".gz", ".zst")):
+        yield from iter_mmap_lines(path)
+        return
+    with open_input(path) as fi:
+        yield from iter_lines(fi)
+
+
+def project(data, fields):
+    '''
+    ツイートからfieldsの値だけを取り出す．'.'区切りはネストしたキーを表す
+    '''
+    record = {}
+    for field in fields:
+        value = data
+        for key in field.split("."):
+            value = value.get(key) if isinstance(value, dict) else None
+        record[field] = value
+    return record
+
+
+def _to_array(values):
+    '''
+    列の値をnumpyの配列にする．型が揃わない列(欠損値を含む列など)はJSON文字列の配列にしてTrueを返す
+    '''
+    if all(type(v) is int for v in values):
+        return np.asarray(values, dtype=np.int64), False
+    if all(type(v) is bool for v in values):
+        return np.asarray(values, dtype=bool), False
+    if all(type(v) in (int, float) for v in values):
+        return np.asarray(values, dtype=np.float64), False
+    if all(type(v) is str for v in values):
+        return np.asarray(values, dtype=str), False
+    return np.asarray([json.dumps(v, ensure_ascii=False) for v in values], dtype=str), True
+
+
+def write_columnar(lines, path, fields):
+    '''
+    射影済みのjsonlの各行をfieldsの列ごとにまとめ，parquetまたはnpzで書き出す
+    '''
+    columns = {field: [] for field in fields}
+    for line in lines:
+        record = json.loads(line)
+        for field in fields:
+            columns[field].append(record[field])
+    if path.endswith(".parquet"):
+        if pyarrow is None:
+            raise ImportError(
+                "pyarrow is required for .parquet files. Run `pip install pyarrow` or use .npz")
+        table = pyarrow.Table.from_pydict(columns)
+        pyarrow.parquet.write_table(table, path, compression="zstd")
+    else:
+        if np is None:
+            raise ImportError(
+                "numpy is required for .npz files. Run `pip install numpy`")
+        arrays, json_fields = {}, []
+        for field, values in columns.items():
+            arrays[field], is_json = _to_array(values)
+            if is_json:
+                json_fields.append(field)
+        with open(path, 'wb') as f:
+            np.savez(f, **arrays, **{NPZ_JSON_FIELDS: np.asarray(json_fields, dtype=str)})
+
+
+def read_records(path, columns=None):
+    '''
+    extract_viral_tweet.pyの出力をdictごとに返す．列指向のファイルではcolumnsの列だけを読み込む
+    '''
+    if path.endswith(".parquet"):
+        if pyarrow is None:
+            raise ImportError(
+                "pyarrow is required for .parquet files. Run `pip install pyarrow`")
+        table = pyarrow.parquet.read_table(path, columns=columns)
+        for batch in table.to_batches():
+            yield from batch.to_pylist()
+    elif path.endswith(".npz"):
+        with np.load(path) as data:
+            json_fields = set(data[NPZ_JSON_FIELDS].tolist()) if NPZ_JSON_FIELDS in data.files else set()
+            arrays = {c: data[c] for c in (columns or data.files) if c != NPZ_JSON_FIELDS}
+        n = len(next(iter(arrays.values()))) if arrays else 0
+        for i in range(n):
+            yield {c: json.loads(a[i].item()) if c in json_fields else a[i].item()
+                   for c, a in arrays.items()}
+    else:
+        for line in read_lines(path):
+            data = json.loads(line)
+            yield project(data, columns) if columns else data
+
+
+def compression_suffix(path):
+    for suffix in (".gz", ".zst"):
+        if path.endswith(suffix):
+            return suffix
+    return ""
+
+
+def extract(fi, fo, args):
+    '''
+    fiの各行(bytes)のうち条件を満たすツイートをバイナリのfoに書き出す
+
+    Returns
+    -------
+    (n_read, n_kept) : (int, int)
+        読み込んだ行数と書き出した行数
+    '''
+    n_read, n_kept = 0, 0
+    prefilter = not args.no_prefilter
+    for line in fi:
+        n_read += 1
+        if prefilter and not may_be_viral(line, args):
+            continue
+        data = json.loads(line)
+        if not is_viral(data, args):
+            continue
+        if args.fields:
+            # 必要なfieldだけを区切りの空白なしで書き出す
+            line = json.dumps(project(data, args.fields),
+                              ensure_ascii=False, separators=(",", ":"))
+        else:
+            line = json.dumps(data,  ensure_ascii=False)
+        fo.write(line.encode("utf-8") + b"\n")
+        n_kept += 1
+    return n_read, n_kept
+
+
+def expand_inputs(patterns: List[str]) -> List[str]:
+    '''
+    globパターンを展開し，重複を除いたファイルのリストを返す(順序は保持)
+    '''
+    paths = []
+    for pattern in patterns:
+        matched = sorted(glob.glob(pattern)) or [pattern]
+        for p in matched:
+            if p not in paths:
+                paths.append(p)
+    return paths
+
+
+def extract_file(job):
+    '''
+    1ファイル分の抽出を行うworker．結果はshard_pathに書き出す
+
+    書き込み途中で止まってもshardが壊れないよう，一時ファイルに書いてから置き換える
+    '''
+    input_path, shard_path, args = job
+    tmp_path = shard_path + ".tmp" + compression_suffix(shard_path)
+    with open_output(tmp_path) as fo:
+        n_read, n_kept = extract(read_lines(input_path, args.mmap), fo, args)
+    os.replace(tmp_path, shard_path)
+    return input_path, n_read, n_kept
+
+
+def manifest_config(args):
+    '''
+    shardの中身に影響する設定．これが変わったらmanifestの記録は使わない
+    '''
+    return {"exclude_verified": args.exclude_verified,
+            "favorite_count": args.favorite_count,
+            "retweet_count": args.retweet_count,
+            "exclude_urls": args.exclude_urls,
+            "fields": args.fields,
+            "shard_suffix": shard_suffix(args.output)}
+
+
+def shard_suffix(output):
+    # shardは出力と同じ形式で圧縮する．gzipのmemberやzstdのframeは連結しても
+    # 1つのファイルとして読めるので，結合はバイト列の連結で済む．
+    # 列指向の出力の場合はjsonlのshardを最後に変換する
+    return ".jsonl" + compression_suffix(output)
+
+
+def load_manifest(manifest_path, config):
+    '''
+    処理済みの入力ファイルの記録を読み込む．設定が異なる場合は空の記録を返す
+    '''
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+    if manifest.get("config") != config:
+        logger.warning(
+            f"options differ from {manifest_path}. all inputs are processed again")
+        return {}
+    return manifest["files"]
+
+
+def save_manifest(manifest_path, config, files):
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({"config": config, "files": files},
+                  f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+
+def is_done(entry, input_path, shard_dir):
+    '''
+    manifestの記録から，入力ファイルが変更されておらずshardも残っているかを判定する
+    '''
+    if entry is None:
+        return False
+    stat = os.stat(input_path)
+    return entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime \
+        and os.path.exists(os.path.join(shard_dir, entry["shard"]))
+
+
+def extract_parallel(input_paths, args):
+    '''
+    入力ファイルごとにworkerへ割り当て，shardを入力順に結合してargs.outputへ書き出す
+
+    処理が終わった入力ファイルはshard_dir/manifest.jsonに記録し，
+    再実行時には変更のないファイルを飛ばす
+    '''
+    shard_dir = args.shard_dir or args.output + ".shards"
+    os.makedirs(shard_dir, exist_ok=True)
+    manifest_path = os.path.join(shard_dir, "manifest.json")
+    config = manifest_config(args)
+    files = {} if args.force else load_manifest(manifest_path, config)
+
+    suffix = shard_suffix(args.output)
+    shard_names = {}
+    for p in input_paths:
+        abspath = os.path.abspath(p)
+        digest = hashlib.md5(abspath.encode("utf-8")).hexdigest()[:8]
+        shard_names[abspath] = f"{os.path.basename(p)}-{digest}{suffix}"
+
+    jobs = [(p, os.path.join(shard_dir, shard_names[os.path.abspath(p)]), args)
+            for p in input_paths
+            if not is_done(files.get(os.path.abspath(p)), p, shard_dir)]
+    logger.info(
+        f"files: {len(input_paths)} done: {len(input_paths) - len(jobs)} todo: {len(jobs)}")
+
+    if jobs:
+        workers = max(1, min(args.workers or 1, len(jobs)))
+        with Pool(workers) as pool:
+            for input_path, n_read, n_kept in pool.imap_unordered(extract_file, jobs):
+                logger.info(f"{input_path}: {n_kept}/{n_read}")
+                stat = os.stat(input_path)
+                abspath = os.path.abspath(input_path)
+                files[abspath] = {"path": abspath, "size": stat.st_size, "mtime": stat.st_mtime,
+                                  "shard": shard_names[abspath], "n_read": n_read, "n_kept": n_kept}
+                # 1ファイル終わるごとに記録するので，中断しても終わったファイルから再開できる
+                save_manifest(manifest_path, config, files)
+
+    # shardは入力順に結合するので，worker数に依らず出力は同じになる
+    entries = [files[os.path.abspath(p)] for p in input_paths]
+    shard_paths = [os.path.join(shard_dir, e["shard"]) for e in entries]
+    if args.output.endswith(COLUMNAR_SUFFIXES):
+        write_columnar((line for shard_path in shard_paths for line in read_lines(shard_path)),
+                       args.output, args.fields)
+    else:
+        with open(args.output, 'wb') as fo:
+            for shard_path in shard_paths:
+                with open(shard_path, 'rb') as fs:
+                    shutil.copyfileobj(fs, fo, BLOCK_SIZE)
+    total_read = sum(e["n_read"] for e in entries)
+    total_kept = sum(e["n_kept"] for e in entries)
+    logger.info(
+        f"files: {len(entries)} read: {total_read} kept: {total_kept}")
+
+
 def main(fi):
     args = parse_args()
-    with open(args.output, 'w') as f:
-        for line in fi:
-            data = json.loads(line)
-            # 公式アカウントを除外
-            if args.exclude_verified:
-                if data["user"]["verified"] is True:
-                    continue
-
-            # followerがfolloingのx倍いる人のツイートを除外
-            # if args.friend_ratio * data["user"]["friends_count"] < data["user"]["followers_count"]:
-            #     continue
-
-            # いいねがx以下のツイートを除外
-            if data["favorite_count"] < args.favorite_count:
-                continue
-            # リツイートがx以下のツイートを除外
-            if data["retweet_count"] < args.retweet_count:
-                continue
-            # urlが貼られているツイートは除外
-            if args.exclude_urls:
-                if is_include_url(data["text"]):
-                    continue
-            print(json.dumps(data,  ensure_ascii=False), file=f)
+    if args.inputs:
+        extract_parallel(expand_inputs(args.inputs), args)
+        return
+    if args.output.endswith(COLUMNAR_SUFFIXES):
+        with tempfile.TemporaryFile() as f:
+            extract(iter_lines(fi), f, args)
+            f.seek(0)
+            write_columnar(iter_lines(f), args.output, args.fields)
+        return
+    with open_output(args.output) as f:
+        extract(iter_lines(fi), f, args)
     return
 
 
 if __name__ == "__main__":
-    main(sys.stdin)
+    main(sys.stdin.buffer)
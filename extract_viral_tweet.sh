@@ -5,15 +5,17 @@
 SAVE_DIR=${1}
 year=${2}
 month=${3}
+workers=${4:-$(nproc)}
 
 f_c=500
 r_c=1
 
 
-zcat /home/work/data/twitter_crawl_daily/tweets-${year}${month}*-json.txt.gz \
-    |python extract_viral_tweet.py --exclude_verified --exclude_urls \
-        --favorite_count ${f_c} \
-        --retweet_count ${r_c} \
-        --output ${SAVE_DIR}/tweets-${year}${month}-fc_${f_c}-rc_${r_c}.jsonl
+python extract_viral_tweet.py --exclude_verified --exclude_urls \
+    --favorite_count ${f_c} \
+    --retweet_count ${r_c} \
+    --workers ${workers} \
+    --output ${SAVE_DIR}/tweets-${year}${month}-fc_${f_c}-rc_${r_c}.jsonl \
+    "/home/work/data/twitter_crawl_daily/tweets-${year}${month}*-json.txt.gz"
 
     
@@ -0,0 +1,225 @@
+'''
+fairseqの辞書(dict.*.txt)とmmap形式のデータセット(.bin/.idx)を直接書き出す
+
+`fairseq-preprocess --dataset-impl mmap`と同じ形式(辞書の並び順，未知語，文末の</s>を含む)なので，
+fairseq-trainの`--dataset-impl 'mmap'`でそのまま読める．辞書はfairseq-preprocessと同じくtrainだけから作る
+
+num_variantsをK(>1)にすると，ツイートごとにK通りのキーワードの組を
+{split}.source-target.source.variants.{bin,idx}に書き出す．i番目のツイートのk通り目は i * K + k 番目にある．
+ツイート(target)は1回だけ書くので，エポックごとにsample_variantsで組を選べばK倍の容量にならない
+'''
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+SPECIAL_SYMBOLS = ["<s>", "<pad>", "</s>", "<unk>"]
+BOS, PAD, EOS, UNK = range(len(SPECIAL_SYMBOLS))
+# fairseqは辞書の大きさを8の倍数にそろえる
+PADDING_FACTOR = 8
+# fairseq-preprocessの出力ではdevをvalidと呼ぶ
+SPLIT_NAMES = {"train": "train", "dev": "valid", "test": "test"}
+
+_HDR_MAGIC = b"MMIDIDX\x00\x00"
+_DTYPE_CODES = {np.dtype(np.int32): 4, np.dtype(np.uint16): 8}
+# 仮のIDの0は文末記号に使う
+_PROVISIONAL_EOS = 0
+VARIANTS_SUFFIX = "variants"
+
+
+def best_fitting_dtype(vocab_size: int):
+    return np.dtype(np.uint16) if vocab_size < 65500 else np.dtype(np.int32)
+
+
+def write_index(path, sizes, dtype):
+    """MMapIndexedDatasetの.idxを書き出す"""
+    sizes = np.asarray(sizes, dtype=np.int32)
+    pointers = np.zeros(len(sizes), dtype=np.int64)
+    np.cumsum(sizes[:-1], out=pointers[1:])
+    pointers *= dtype.itemsize
+    with open(path, 'wb') as fout:
+        fout.write(_HDR_MAGIC)
+        fout.write(struct.pack("<Q", 1))
+        fout.write(struct.pack("<B", _DTYPE_CODES[dtype]))
+        fout.write(struct.pack("<Q", len(sizes)))
+        fout.write(sizes.tobytes(order="C"))
+        fout.write(pointers.tobytes(order="C"))
+
+
+def read_dataset(prefix):
+    """prefix.idxとprefix.binを読み，各文のトークンIDの配列のリストを返す(確認用)"""
+    with open(prefix + ".idx", 'rb') as fin:
+        assert fin.read(len(_HDR_MAGIC)) == _HDR_MAGIC
+        assert struct.unpack("<Q", fin.read(8)) == (1,)
+        code, = struct.unpack("<B", fin.read(1))
+        dtype = {v: k for k, v in _DTYPE_CODES.items()}[code]
+        n, = struct.unpack("<Q", fin.read(8))
+        sizes = np.frombuffer(fin.read(4 * n), dtype=np.int32)
+        pointers = np.frombuffer(fin.read(8 * n), dtype=np.int64)
+    data = np.memmap(prefix + ".bin", dtype=dtype, mode='r')
+    return [np.array(data[p // dtype.itemsize:p // dtype.itemsize + s])
+            for p, s in zip(pointers, sizes)]
+
+
+class Vocabulary(object):
+    """
+    トークンに出現順の仮のIDを振り，trainでの出現回数を数える．
+    finalizeでfairseqのDictionaryと同じ並び順に直し，仮のIDから本当のIDへの対応表を返す
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.symbols = [None]
+        self.counts = [0]
+
+    def encode(self, tokens, count=True):
+        ids = []
+        for token in tokens:
+            i = self.ids.get(token)
+            if i is None:
+                i = self.ids[token] = len(self.symbols)
+                self.symbols.append(token)
+                self.counts.append(0)
+            if count:
+                self.counts[i] += 1
+            ids.append(i)
+        ids.append(_PROVISIONAL_EOS)
+        return ids
+
+    def finalize(self):
+        """
+        Returns
+        -------
+        entries : List[(str, int)]
+            辞書ファイルに書く(トークン, 出現回数)．特殊記号は含まない
+        remap : np.ndarray
+            仮のIDから本当のIDへの対応表．trainに出てこないトークンは<unk>になる
+        """
+        # fairseqのDictionary.finalizeと同じく出現回数の多い順，同じ回数ならトークンの順に並べる
+        order = sorted((i for i in range(1, len(self.symbols)) if self.counts[i] > 0),
+                       key=lambda i: (-self.counts[i], self.symbols[i]))
+        remap = np.full(len(self.symbols), UNK, dtype=np.int64)
+        remap[_PROVISIONAL_EOS] = EOS
+        remap[order] = np.arange(len(SPECIAL_SYMBOLS), len(SPECIAL_SYMBOLS) + len(order))
+        entries = [(self.symbols[i], self.counts[i]) for i in order]
+        n_madeup = -(len(SPECIAL_SYMBOLS) + len(entries)) % PADDING_FACTOR
+        entries += [("madeupword{:04d}".format(i), 0) for i in range(n_madeup)]
+        return entries, remap
+
+
+class FairseqDataWriter(object):
+    """
+    (キーワード, ツイート)の組を受け取り，fairseq-preprocessの出力と同じファイルをdestdirに書き出す
+
+    書き出している間は仮のIDを一時ファイルに書き，close時に辞書の順のIDに置き換えて.binにする
+    """
+
+    def __init__(self, destdir, source_lang="source", target_lang="target", num_variants=1,
+                 chunk_tokens=1 << 22):
+        self.destdir = destdir
+        self.langs = (source_lang, target_lang)
+        self.num_variants = num_variants
+        self._chunk_tokens = chunk_tokens
+        os.makedirs(destdir, exist_ok=True)
+        self._tmp_dir = tempfile.TemporaryDirectory(dir=destdir)
+        self.vocabs = {lang: Vocabulary() for lang in self.langs}
+        self._files = {}
+        self._sizes = {}
+
+    def add(self, split: str, sources, target: str):
+        """sourcesはnum_variants通りのキーワードのリスト(1つだけなら文字列でもよい)"""
+        if isinstance(sources, str):
+            sources = [sources]
+        assert len(sources) == self.num_variants, sources
+        source_lang, target_lang = self.langs
+        # 辞書はtrainだけで数える．variantsがある場合はそちらで数える
+        is_train = split == "train"
+        self._write(split, source_lang, source_lang, sources[0], is_train and self.num_variants == 1)
+        self._write(split, target_lang, target_lang, target, is_train)
+        if self.num_variants > 1:
+            stream = "{}.{}".format(source_lang, VARIANTS_SUFFIX)
+            for source in sources:
+                self._write(split, stream, source_lang, source, is_train)
+
+    def _write(self, split, stream, lang, line, count):
+        ids = self.vocabs[lang].encode(line.split(), count=count)
+        key = (split, stream)
+        if key not in self._files:
+            self._files[key] = open(os.path.join(self._tmp_dir.name, "{}.{}".format(*key)), 'wb')
+            self._sizes[key] = []
+        self._files[key].write(np.asarray(ids, dtype=np.int32).tobytes())
+        self._sizes[key].append(len(ids))
+
+    def close(self):
+        for fout in self._files.values():
+            fout.close()
+        for lang in self.langs:
+            entries, remap = self.vocabs[lang].finalize()
+            with open(os.path.join(self.destdir, "dict.{}.txt".format(lang)), 'w') as fout:
+                for symbol, count in entries:
+                    print(f"{symbol} {count}", file=fout)
+            dtype = best_fitting_dtype(len(SPECIAL_SYMBOLS) + len(entries))
+            streams = [lang]
+            if lang == self.langs[0] and self.num_variants > 1:
+                streams.append("{}.{}".format(lang, VARIANTS_SUFFIX))
+            for split in SPLIT_NAMES:
+                for stream in streams:
+                    if (split, stream) in self._files:
+                        self._write_dataset(split, stream, remap, dtype)
+        self._tmp_dir.cleanup()
+
+    def _write_dataset(self, split, stream, remap, dtype):
+        prefix = os.path.join(self.destdir, "{}.{}-{}.{}".format(
+            SPLIT_NAMES[split], self.langs[0], self.langs[1], stream))
+        tmp_path = os.path.join(self._tmp_dir.name, f"{split}.{stream}")
+        provisional = np.memmap(tmp_path, dtype=np.int32, mode='r') \
+            if os.path.getsize(tmp_path) > 0 else np.zeros(0, dtype=np.int32)
+        with open(prefix + ".bin", 'wb') as fout:
+            for start in range(0, len(provisional), self._chunk_tokens):
+                chunk = provisional[start:start + self._chunk_tokens]
+                fout.write(remap[chunk].astype(dtype).tobytes())
+        del provisional
+        write_index(prefix + ".idx", self._sizes[split, stream], dtype)
+
+
+def sample_variants(n_items: int, num_variants: int, epoch: int, seed: int = 1) -> np.ndarray:
+    """
+    エポックごとに各ツイートのキーワードの組を1つ選び，variantsのデータセットでの番号を返す．
+    同じseedとepochなら同じ組を選ぶ
+    """
+    rng = np.random.default_rng([seed, epoch])
+    return np.arange(n_items) * num_variants + rng.integers(num_variants, size=n_items)
+
+
+def test_fairseq_data_writer():
+    with tempfile.TemporaryDirectory() as destdir:
+        writer = FairseqDataWriter(destdir, chunk_tokens=3)
+        writer.add("train", "猫 [SEP] 犬", "猫 と 犬")
+        writer.add("train", "猫", "猫 だ")
+        writer.add("dev", "鳥", "猫 と 鳥")
+        writer.close()
+        with open(os.path.join(destdir, "dict.target.txt")) as fin:
+            target_dict = [line.split()[0] for line in fin]
+        assert target_dict == ["猫", "だ", "と", "犬"], target_dict
+        assert len(target_dict) + len(SPECIAL_SYMBOLS) == PADDING_FACTOR
+        train = read_dataset(os.path.join(destdir, "train.source-target.target"))
+        assert [s.tolist() for s in train] == [[4, 6, 7, EOS], [4, 5, EOS]], train
+        valid = read_dataset(os.path.join(destdir, "valid.source-target.source"))
+        assert [s.tolist() for s in valid] == [[UNK, EOS]], valid
+
+
+def test_keyword_variants():
+    with tempfile.TemporaryDirectory() as destdir:
+        writer = FairseqDataWriter(destdir, num_variants=2)
+        writer.add("train", ["猫 [SEP] 犬", "犬"], "猫 と 犬")
+        writer.add("train", ["猫", "猫"], "猫 だ")
+        writer.close()
+        prefix = os.path.join(destdir, "train.source-target.")
+        sources = read_dataset(prefix + "source")
+        variants = read_dataset(prefix + "source." + VARIANTS_SUFFIX)
+        assert len(read_dataset(prefix + "target")) == 2 and len(variants) == 4
+        assert [s.tolist() for s in sources] == [v.tolist() for v in variants[::2]]
+        picked = sample_variants(2, 2, epoch=3)
+        assert picked.tolist() == sample_variants(2, 2, epoch=3).tolist()
+        assert picked[0] in (0, 1) and picked[1] in (2, 3)
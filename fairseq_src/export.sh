@@ -0,0 +1,10 @@
+### export a generation-ready model ###
+. setting.sh
+
+python src/export_generator.py ${DATA_DIR} \
+	--path ${MODEL_DIR}/checkpoint_best.pt \
+	--source-lang source \
+	--target-lang target \
+	--cpu \
+	--export-dir ${MODEL_DIR}/generator \
+	--quantize
@@ -0,0 +1,12 @@
+### generation server ###
+. setting.sh
+
+python src/generation_server.py ${DATA_DIR} \
+	--path ${MODEL_DIR}/checkpoint_best.pt \
+	--source-lang source \
+	--target-lang target \
+	--nbest 5 \
+	--cpu \
+	--socket ${DIR}/generation.sock \
+	--max-batch 64 \
+	--max-wait-ms 10
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3 -u
+"""
+生成用のモデルを書き出す
+
+checkpointからoptimizerの状態を除き，make_generation_fast_を済ませたモデルと辞書をexport_dirに書き出す．
+--quantizeを付けるとLinear, LSTM, LSTMCellをint8に動的量子化する(CPU用)．
+interactive-for-japanese.pyやgeneration_server.pyに`export_dir --generator-artifact export_dir`を渡すと，
+checkpointを読み込む代わりにこれをmmapで読み込む
+"""
+import logging
+import os
+import sys
+import tempfile
+
+import torch
+
+from fairseq import options
+
+from keyword_generator import (ARTIFACT_NAME, KeywordGenerator, build_tiny_generator, load_artifact,
+                               quantize, write_tiny_dictionaries)
+
+
+logging.basicConfig(
+    format='%(asctime)s | %(levelname)s | %(name)s | %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S',
+    level=logging.INFO,
+    stream=sys.stdout,
+)
+logger = logging.getLogger('export_generator')
+
+
+def export(keyword_generator, export_dir, quantize_model=False):
+    assert len(keyword_generator.models) == 1, 'export supports a single model'
+    # make_generation_fast_の後のeval()はNoneを返すので，戻り値は使わない
+    model = keyword_generator.models[0].cpu()
+    model.eval()
+    if quantize_model:
+        model = quantize(model)
+    os.makedirs(export_dir, exist_ok=True)
+    # make_generation_fast_がインスタンスに設定したtrain(ローカル関数)はpickleできないので，保存する間だけ外す
+    train = model.__dict__.pop('train', None)
+    try:
+        # モデルだけを保存するので，checkpointにあるoptimizerの状態は含まれない
+        torch.save(model, os.path.join(export_dir, ARTIFACT_NAME))
+    finally:
+        if train is not None:
+            model.train = train
+    keyword_generator.src_dict.save(os.path.join(
+        export_dir, 'dict.{}.txt'.format(keyword_generator.args.source_lang)))
+    keyword_generator.tgt_dict.save(os.path.join(
+        export_dir, 'dict.{}.txt'.format(keyword_generator.args.target_lang)))
+    return os.path.join(export_dir, ARTIFACT_NAME)
+
+
+def main(args):
+    logger.info(args)
+    keyword_generator = KeywordGenerator(args)
+    path = export(keyword_generator, args.export_dir, args.quantize)
+    logger.info('exported to {} ({:.1f}MB)'.format(path, os.path.getsize(path) / 2 ** 20))
+
+
+def test_export():
+    with tempfile.TemporaryDirectory() as data_dir:
+        write_tiny_dictionaries(data_dir)
+        torch.manual_seed(1)
+        keyword_generator = build_tiny_generator(data_dir)
+        queries = ["猫", "犬[SEP]雨", "空[SEP]晴[SEP]猫"]
+        expected = keyword_generator.generate(queries)
+        export_dir = os.path.join(data_dir, "artifact")
+        export(keyword_generator, export_dir)
+        exported = KeywordGenerator(keyword_generator.args, models=[load_artifact(export_dir)])
+        assert exported.generate(queries) == expected
+        export(keyword_generator, os.path.join(data_dir, "quantized"), quantize_model=True)
+        quantized = KeywordGenerator(keyword_generator.args,
+                                     models=[load_artifact(os.path.join(data_dir, "quantized"))])
+        assert len(quantized.generate(queries)) == len(queries)
+
+
+def cli_main():
+    parser = options.get_generation_parser(interactive=True)
+    group = parser.add_argument_group('Export')
+    group.add_argument('--export-dir', required=True, help='output directory of the artifact')
+    group.add_argument('--quantize', action='store_true',
+                       help='apply dynamic int8 quantization to Linear, LSTM and LSTMCell layers')
+    args = options.parse_args_and_arch(parser)
+    main(args)
+
+
+if __name__ == '__main__':
+    cli_main()
@@ -0,0 +1,201 @@
+"""
+生成結果のキャッシュ
+
+キーはencode_fn後のキーワード(トークン列)と，生成の設定(beam, nbestなど)とcheckpointのパス，サイズ，更新時刻から作る．
+メモリ上ではLRUとTTLで捨て，db_pathを指定するとsqliteにも保存してプロセスを再起動しても使えるようにする．
+sqliteからもTTLより古い結果は消す
+"""
+from collections import OrderedDict
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+
+# 結果に影響する生成の設定
+GENERATION_SETTINGS = ["beam", "nbest", "max_len_a", "max_len_b", "min_len", "lenpen", "unkpen",
+                       "no_repeat_ngram_size", "remove_bpe", "replace_unk", "model_overrides",
+                       "temperature", "diverse_beam_groups", "diverse_beam_strength", "match_source_len",
+                       "prefix_size", "fp16", "cpu_quantize"]
+
+
+def checkpoint_hash(paths):
+    """
+    checkpoint(os.pathsepで区切った複数も可)のパス，サイズ，更新時刻のmd5を返す
+
+    中身を全て読むと大きなcheckpointでは起動が数秒遅くなるので，ファイルの情報だけを使う．
+    checkpointを上書きすれば更新時刻が変わるので別のキャッシュになる
+    """
+    md5 = hashlib.md5()
+    for path in paths.split(os.pathsep):
+        stat = os.stat(path)
+        md5.update("{}\t{}\t{}\n".format(os.path.realpath(path), stat.st_size, stat.st_mtime_ns).encode())
+    return md5.hexdigest()
+
+
+def cache_namespace(args, model_hash):
+    settings = {name: getattr(args, name, None) for name in GENERATION_SETTINGS}
+    settings["checkpoint"] = model_hash
+    return json.dumps(settings, sort_keys=True, default=str)
+
+
+class GenerationCache(object):
+    """
+    encode_fn後のキーワードから生成結果を引くキャッシュ．
+    maxsize個までをメモリにLRUで持ち，ttl秒(Noneなら無期限)より古いものは使わない
+    """
+
+    def __init__(self, namespace, maxsize=10000, ttl=None, db_path=None):
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._db = None
+        if db_path is not None:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS generations (key TEXT PRIMARY KEY, value TEXT, created REAL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS generations_created ON generations (created)")
+            self._db.commit()
+
+    def key(self, encoded: str) -> str:
+        # 空白の違いは同じ入力として扱う
+        encoded = " ".join(encoded.split())
+        return hashlib.sha1("{}\n{}".format(self.namespace, encoded).encode()).hexdigest()
+
+    def _is_fresh(self, created, now):
+        return self.ttl is None or now - created <= self.ttl
+
+    def get(self, encoded):
+        """キャッシュにあれば生成結果を，なければNoneを返す"""
+        key = self.key(encoded)
+        now = time.time()
+        with self._lock:
+            item = self._memory.get(key)
+            if item is not None:
+                created, value = item
+                if self._is_fresh(created, now):
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._memory[key]
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, created FROM generations WHERE key = ?", (key,)).fetchone()
+                if row is not None and self._is_fresh(row[1], now):
+                    value = json.loads(row[0])
+                    self._put_memory(key, row[1], value)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return value
+                if row is not None:
+                    self._db.execute("DELETE FROM generations WHERE key = ?", (key,))
+                    self._db.commit()
+            self.misses += 1
+            return None
+
+    def put(self, encoded, value):
+        key = self.key(encoded)
+        now = time.time()
+        with self._lock:
+            self._put_memory(key, now, value)
+            if self._db is not None:
+                if self.ttl is not None:
+                    self._db.execute("DELETE FROM generations WHERE created < ?", (now - self.ttl,))
+                self._db.execute("INSERT OR REPLACE INTO generations VALUES (?, ?, ?)",
+                                 (key, json.dumps(value, ensure_ascii=False), now))
+                self._db.commit()
+
+    def _put_memory(self, key, created, value):
+        if self.maxsize <= 0:
+            return
+        self._memory[key] = (created, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
+
+    def info(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                "hit_rate": self.hits / max(lookups, 1), "currsize": len(self._memory)}
+
+
+def add_cache_args(parser):
+    group = parser.add_argument_group('Cache')
+    group.add_argument('--cache-size', type=int, default=0,
+                       help='number of generation results kept in memory (0: disabled unless --cache-db)')
+    group.add_argument('--cache-ttl', type=float, default=None, help='seconds a cached result stays valid')
+    group.add_argument('--cache-db', default=None, help='sqlite file that keeps cached results across restarts')
+    return parser
+
+
+def build_cache(args, model_hash=None, model_path=None):
+    """
+    argsの設定からGenerationCacheを作る．キャッシュを使わない場合はNoneを返す
+
+    model_hashを省略するとmodel_path(省略時は--path)の中身のハッシュ値を使う
+    """
+    if getattr(args, 'cache_size', 0) <= 0 and getattr(args, 'cache_db', None) is None:
+        return None
+    if args.sampling:
+        # サンプリングは毎回違う結果を返すのでキャッシュしない
+        return None
+    if model_hash is None:
+        model_hash = checkpoint_hash(model_path or args.path)
+    return GenerationCache(cache_namespace(args, model_hash), args.cache_size,
+                           args.cache_ttl, args.cache_db)
+
+
+def test_generation_cache():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, "cache.sqlite")
+        cache = GenerationCache("model-a", maxsize=2, db_path=db_path)
+        assert cache.get("猫 [SEP] 雨") is None
+        cache.put("猫 [SEP] 雨", [[-1.0, "雨の猫"]])
+        assert cache.get("猫  [SEP] 雨 ") == [[-1.0, "雨の猫"]]
+        cache.put("犬", [[-2.0, "犬"]])
+        cache.put("空", [[-3.0, "空"]])
+        assert len(cache._memory) == 2
+        # メモリから追い出されてもsqliteから引ける
+        assert cache.get("猫 [SEP] 雨") == [[-1.0, "雨の猫"]] and cache.disk_hits == 1
+        assert GenerationCache("model-b", db_path=db_path).get("犬") is None
+        assert GenerationCache("model-a", db_path=db_path).get("犬") == [[-2.0, "犬"]]
+        expired = GenerationCache("model-a", ttl=-1, db_path=db_path)
+        assert expired.get("犬") is None
+        # 期限切れの行はsqliteからも消える
+        n_rows = "SELECT COUNT(*) FROM generations"
+        assert expired._db.execute(n_rows).fetchone()[0] == 2
+        expired.put("雪", [[-4.0, "雪"]])
+        assert expired._db.execute(n_rows).fetchone()[0] == 1
+        assert cache.info()["hits"] == 2 and cache.info()["misses"] == 1
+
+
+def test_cache_namespace():
+    args = argparse.Namespace(beam=5, nbest=5, temperature=1.0, diverse_beam_groups=-1)
+    namespace = cache_namespace(args, "model-a")
+    assert cache_namespace(argparse.Namespace(**vars(args)), "model-a") == namespace
+    assert cache_namespace(argparse.Namespace(**vars(args)), "model-b") != namespace
+    for name, value in [("temperature", 0.5), ("diverse_beam_groups", 2), ("cpu_quantize", True), ("fp16", True)]:
+        changed = argparse.Namespace(**dict(vars(args), **{name: value}))
+        assert cache_namespace(changed, "model-a") != namespace, name
+
+
+def test_checkpoint_hash():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "checkpoint_best.pt")
+        with open(path, 'wb') as fout:
+            fout.write(b"weights")
+        model_hash = checkpoint_hash(path)
+        assert checkpoint_hash(path) == model_hash
+        with open(path, 'wb') as fout:
+            fout.write(b"new weights")
+        os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1))
+        assert checkpoint_hash(path) != model_hash
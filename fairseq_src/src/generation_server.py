@@ -0,0 +1,232 @@
+#!/usr/bin/env python3 -u
+"""
+キーワードからツイートを生成するサーバ
+
+checkpointを起動時に1回だけ読み込み，TCPまたはUnixソケットで1行1リクエストのJSONを受け付ける．
+    {"keywords": "猫[SEP]雨"} -> {"outputs": [{"score": -3.2, "tweet": "..."}, ...]}
+    {"stats": true}           -> {"requests": ..., "mean_batch_size": ..., "latency_ms": {"p50": ..., ...},
+                                  "cache": {"hits": ..., "hit_rate": ..., ...}}
+同時に届いたリクエストは最大--max-wait-msだけ待って--max-batch件までまとめ，1回のinference_stepで生成する．
+--cache-sizeか--cache-dbを指定すると，同じキーワードと設定の結果はモデルを通さずに返す
+"""
+import asyncio
+from collections import deque
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from fairseq import options
+
+from generation_cache import GenerationCache, add_cache_args, build_cache
+from keyword_generator import (KeywordGenerator, add_artifact_args, add_cpu_args, build_tiny_generator,
+                               model_path, write_tiny_dictionaries)
+
+
+logging.basicConfig(
+    format='%(asctime)s | %(levelname)s | %(name)s | %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S',
+    level=logging.INFO,
+    stream=sys.stdout,
+)
+logger = logging.getLogger('generation_server')
+
+
+class MicroBatcher(object):
+    """
+    submitされた入力をキューに溜め，最初の入力から最大max_waitだけ待ってmax_batch件までまとめて生成する
+
+    生成(generate)はスレッドで1バッチずつ行うので，その間もリクエストを受け付けられる
+    """
+
+    def __init__(self, generate, max_batch=64, max_wait=0.01, max_latencies=10000, cache=None):
+        self.generate = generate
+        self.cache = cache
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = None
+        self.n_requests = 0
+        self.n_batches = 0
+        self.latencies = deque(maxlen=max_latencies)
+
+    async def submit(self, line):
+        future = asyncio.get_running_loop().create_future()
+        await self._queue().put((line, future, time.perf_counter()))
+        return await future
+
+    def _queue(self):
+        # キューは動いているイベントループの中で作る
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        return self.queue
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        queue = self._queue()
+        while True:
+            items = [await queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(items) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                outputs = await loop.run_in_executor(
+                    None, self.generate, [line for line, _, _ in items])
+            except Exception as e:
+                logger.exception('generation failed')
+                for _, future, _ in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            # generateは入力と同じ順に結果を返し，生成できなかった入力だけNoneになる
+            now = time.perf_counter()
+            for (line, future, start), output in zip(items, outputs):
+                self.latencies.append(now - start)
+                if future.done():
+                    continue
+                if output is None:
+                    future.set_exception(ValueError('input is too long to generate: {!r}'.format(line)))
+                else:
+                    future.set_result(output)
+            self.n_requests += len(items)
+            self.n_batches += 1
+
+    def stats(self):
+        stats = {"requests": self.n_requests,
+                 "mean_batch_size": self.n_requests / max(self.n_batches, 1)}
+        if self.latencies:
+            p50, p90, p99 = np.percentile(np.array(self.latencies) * 1000, [50, 90, 99])
+            stats["latency_ms"] = {"p50": p50, "p90": p90, "p99": p99}
+        if self.cache is not None:
+            stats["cache"] = self.cache.info()
+        return stats
+
+
+async def handle_connection(reader, writer, batcher):
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        try:
+            request = json.loads(line)
+            if request.get("stats"):
+                response = batcher.stats()
+            else:
+                outputs = await batcher.submit(request["keywords"])
+                response = {"outputs": [{"score": score, "tweet": tweet} for score, tweet in outputs]}
+        except Exception as e:
+            response = {"error": repr(e)}
+        writer.write(json.dumps(response, ensure_ascii=False).encode() + b"\n")
+        await writer.drain()
+    writer.close()
+
+
+async def start_server(batcher, socket_path=None, host='127.0.0.1', port=8080):
+    def handler(reader, writer):
+        return handle_connection(reader, writer, batcher)
+    if socket_path is not None:
+        return await asyncio.start_unix_server(handler, path=socket_path)
+    return await asyncio.start_server(handler, host, port)
+
+
+async def serve(batcher, args):
+    server = await start_server(batcher, args.socket, args.host, args.port)
+    logger.info('listening on {}'.format(args.socket or '{}:{}'.format(args.host, args.port)))
+    batch_task = asyncio.ensure_future(batcher.run())
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batch_task.cancel()
+
+
+def main(args):
+    if args.max_tokens is None and args.max_sentences is None:
+        args.max_sentences = args.max_batch
+    logger.info(args)
+    cache = build_cache(args, model_path=model_path(args))
+    keyword_generator = KeywordGenerator(args, cache=cache)
+    batcher = MicroBatcher(keyword_generator.generate, args.max_batch, args.max_wait_ms / 1000,
+                           cache=cache)
+    asyncio.run(serve(batcher, args))
+
+
+def add_server_args(parser):
+    group = parser.add_argument_group('Server')
+    group.add_argument('--socket', default=None, help='path of a Unix socket (TCP if omitted)')
+    group.add_argument('--host', default='127.0.0.1', help='host of the TCP server')
+    group.add_argument('--port', type=int, default=8080, help='port of the TCP server')
+    group.add_argument('--max-batch', type=int, default=64, help='maximum number of requests generated at once')
+    group.add_argument('--max-wait-ms', type=float, default=10,
+                       help='maximum time to wait for more requests before generating')
+    return parser
+
+
+def test_server():
+    with tempfile.TemporaryDirectory() as data_dir:
+        write_tiny_dictionaries(data_dir)
+        torch.manual_seed(1)
+        cache = GenerationCache("tiny-lstm", maxsize=100)
+        keyword_generator = build_tiny_generator(data_dir, ['--max-source-positions', '8'], cache=cache)
+        batcher = MicroBatcher(keyword_generator.generate, max_batch=8, max_wait=0.05, cache=cache)
+        socket_path = os.path.join(data_dir, "server.sock")
+        # 長すぎる入力はそのリクエストだけがエラーになり，同じバッチの他のリクエストには正しい結果が返る
+        too_long = "猫犬空雨晴猫犬空雨晴"
+        queries = ["猫", "犬[SEP]雨", too_long, "空[SEP]晴[SEP]猫"] + ["猫", "犬[SEP]雨", "空[SEP]晴[SEP]猫"] * 3
+
+        async def request(message):
+            reader, writer = await asyncio.open_unix_connection(socket_path)
+            writer.write(json.dumps(message).encode() + b"\n")
+            response = json.loads(await reader.readline())
+            writer.close()
+            return response
+
+        async def run():
+            server = await start_server(batcher, socket_path=socket_path)
+            batch_task = asyncio.ensure_future(batcher.run())
+            responses = await asyncio.gather(*[request({"keywords": q}) for q in queries])
+            stats = await request({"stats": True})
+            batch_task.cancel()
+            server.close()
+            await server.wait_closed()
+            return responses, stats
+
+        responses, stats = asyncio.run(run())
+        for query, response in zip(queries, responses):
+            if query == too_long:
+                assert "error" in response, response
+            else:
+                assert len(response["outputs"]) == 2, response
+        assert stats["requests"] == len(queries), stats
+        assert stats["mean_batch_size"] > 1, stats
+        assert stats["latency_ms"]["p50"] <= stats["latency_ms"]["p99"], stats
+        # 同じキーワードは同じ結果になり，2回目以降はモデルを通さない
+        expected = dict(zip(queries, keyword_generator._generate(queries)))
+        for query, response in zip(queries, responses):
+            assert response == responses[queries.index(query)], (query, response)
+            if query != too_long:
+                assert [(o["score"], o["tweet"]) for o in response["outputs"]] == expected[query], query
+        assert stats["cache"]["misses"] == len(set(queries)), stats
+
+
+def cli_main():
+    parser = options.get_generation_parser(interactive=True)
+    parser = add_cpu_args(add_artifact_args(add_cache_args(add_server_args(parser))))
+    args = options.parse_args_and_arch(parser)
+    main(args)
+
+
+if __name__ == '__main__':
+    cli_main()
@@ -12,12 +12,11 @@ import fileinput
 import logging
 import math
 import sys
-import os
 
-import torch
+from fairseq import options, utils
 
-from fairseq import checkpoint_utils, options, tasks, utils
-from fairseq.data import encoders
+from generation_cache import add_cache_args, build_cache
+from keyword_generator import KeywordGenerator, add_artifact_args, add_cpu_args, base2_score, model_path
 
 
 logging.basicConfig(
@@ -29,7 +28,6 @@ logging.basicConfig(
 logger = logging.getLogger('fairseq_cli.interactive')
 
 
-Batch = namedtuple('Batch', 'ids src_tokens src_lengths')
 Translation = namedtuple('Translation', 'src_str hypos pos_scores alignments')
 
 
@@ -46,35 +44,12 @@ def buffered_read(input, buffer_size):
         yield buffer
 
 
-def make_batches(lines, args, task, max_positions, encode_fn):
-    tokens = [
-        task.source_dictionary.encode_line(
-            encode_fn(src_str), add_if_not_exist=False
-        ).long()
-        for src_str in lines
-    ]
-    lengths = [t.numel() for t in tokens]
-    itr = task.get_batch_iterator(
-        dataset=task.build_dataset_for_inference(tokens, lengths),
-        max_tokens=args.max_tokens,
-        max_sentences=args.max_sentences,
-        max_positions=max_positions,
-        ignore_invalid_inputs=args.skip_invalid_size_inputs_valid_test
-    ).next_epoch_itr(shuffle=False)
-    for batch in itr:
-        yield Batch(
-            ids=batch['id'],
-            src_tokens=batch['net_input']['src_tokens'], src_lengths=batch['net_input']['src_lengths'],
-        )
-
-
 def main(args):
-    utils.import_user_module(args)
-
     if args.buffer_size < 1:
         args.buffer_size = 1
     if args.max_tokens is None and args.max_sentences is None:
-        args.max_sentences = 1
+        # additional: generate everything in the buffer together instead of one input at a time
+        args.max_sentences = args.buffer_size
 
     assert not args.sampling or args.nbest == args.beam, \
         '--sampling requires --nbest to be equal to --beam'
@@ -83,74 +58,13 @@ def main(args):
 
     logger.info(args)
 
-    use_cuda = torch.cuda.is_available() and not args.cpu
-
-    # Setup task, e.g., translation
-    task = tasks.setup_task(args)
-
-    # Load ensemble
-    logger.info('loading model(s) from {}'.format(args.path))
-    models, _model_args = checkpoint_utils.load_model_ensemble(
-        args.path.split(os.pathsep),
-        arg_overrides=eval(args.model_overrides),
-        task=task,
-    )
-
-    # Set dictionaries
-    src_dict = task.source_dictionary
-    tgt_dict = task.target_dictionary
-
-    # Optimize ensemble for generation
-    for model in models:
-        model.make_generation_fast_(
-            beamable_mm_beam_size=None if args.no_beamable_mm else args.beam,
-            need_attn=args.print_alignment,
-        )
-        if args.fp16:
-            model.half()
-        if use_cuda:
-            model.cuda()
-
-    # Initialize generator
-    generator = task.build_generator(models, args)
-    # generator = task.build_generator(args)  # additional
-
-    # Handle tokenization and BPE
-    tokenizer = encoders.build_tokenizer(args)
-    bpe = encoders.build_bpe(args)
-
-    def encode_fn(x):
-        if tokenizer is not None:
-            x = tokenizer.encode(x)
-        if bpe is not None:
-            x = bpe.encode(x)
-        # x = " ".join(x)  # additional
-        x = ' [SEP] '.join(
-            list(map(lambda x: ' '.join(list(x)), x.split('[SEP]'))))
-        return x.strip()
-
-    def decode_fn(x):
-        if bpe is not None:
-            x = bpe.decode(x)
-        if tokenizer is not None:
-            x = tokenizer.decode(x)
-        return x
-
-    def decode_fn(x):
-        if bpe is not None:
-            x = bpe.decode(x)
-        if tokenizer is not None:
-            x = tokenizer.decode(x)
-        return x
-
-    # Load alignment dictionary for unknown word replacement
-    # (None if no unknown word replacement, empty if no path to align dictionary)
-    align_dict = utils.load_align_dict(args.replace_unk)
-
-    max_positions = utils.resolve_max_positions(
-        task.max_positions(),
-        *[model.max_positions() for model in models]
-    )
+    # additional: model loading, generator and encode_fn/decode_fn are shared with generation_server.py
+    cache = build_cache(args, model_path=model_path(args))
+    keyword_generator = KeywordGenerator(args, cache=cache)
+    src_dict = keyword_generator.src_dict
+    tgt_dict = keyword_generator.tgt_dict
+    align_dict = keyword_generator.align_dict
+    decode_fn = keyword_generator.decode_fn
 
     if args.buffer_size > 1:
         logger.info('Sentence buffer size: %s', args.buffer_size)
@@ -158,27 +72,24 @@ def main(args):
     logger.info('Type the input sentence and press return:')
     start_id = 0
     for inputs in buffered_read(args.input, args.buffer_size):
-        results = []
-        for batch in make_batches(inputs, args, task, max_positions, encode_fn):
-            src_tokens = batch.src_tokens
-            src_lengths = batch.src_lengths
-            if use_cuda:
-                src_tokens = src_tokens.cuda()
-                src_lengths = src_lengths.cuda()
-
-            sample = {
-                'net_input': {
-                    'src_tokens': src_tokens,
-                    'src_lengths': src_lengths,
-                },
-            }
-            translations = task.inference_step(generator, models, sample)
-            for i, (id, hypos) in enumerate(zip(batch.ids.tolist(), translations)):
-                src_tokens_i = utils.strip_pad(src_tokens[i], tgt_dict.pad())
-                results.append((start_id + id, src_tokens_i, hypos))
-
-        # sort output to match input order
-        for id, src_tokens, hypos in sorted(results, key=lambda x: x[0]):
+        if cache is not None:
+            # additional: cached inputs skip the model; only the input and outputs are printed
+            for src_str, candidates in zip(inputs, keyword_generator.generate(inputs)):
+                if candidates is None:
+                    # the same as the uncached path: skipped with --skip-invalid-size-inputs-valid-test
+                    if args.skip_invalid_size_inputs_valid_test:
+                        continue
+                    raise Exception('Size of the input {!r} is invalid (max positions {})'.format(
+                        src_str, keyword_generator.max_positions))
+                print('input: {}'.format(keyword_generator.source_string(src_str)))
+                for score, detok_hypo_str in candidates:
+                    print("output: {}\t{}".format(score, detok_hypo_str))
+            start_id += len(inputs)
+            continue
+        results = keyword_generator.translate(inputs, start_id)
+
+        # translate() returns results in input order
+        for id, src_tokens, hypos in results:
             if src_dict is not None:
                 src_str = src_dict.string(src_tokens, args.remove_bpe)
                 # print('S-{}\t{}'.format(id, src_str))
@@ -195,7 +106,7 @@ def main(args):
                     remove_bpe=args.remove_bpe,
                 )
                 detok_hypo_str = decode_fn(hypo_str)
-                score = hypo['score'] / math.log(2)  # convert to base 2
+                score = base2_score(hypo['score'])  # convert to base 2, same value as the cached path
 
                 print("output: {}\t{}".format(
                     score, detok_hypo_str))  # additional
@@ -223,12 +134,14 @@ def main(args):
 
         # update running id counter
         start_id += len(inputs)
+    if cache is not None:
+        logger.info('cache: {}'.format(cache.info()))
 
 
 def cli_main():
     parser = options.get_generation_parser(interactive=True)
+    parser = add_cpu_args(add_artifact_args(add_cache_args(parser)))
     args = options.parse_args_and_arch(parser)
-    args.max_sentences = 1
     main(args)
 
 
@@ -0,0 +1,344 @@
+"""
+学習済みモデルとgeneratorを1回だけ用意し，キーワードからツイートを生成する
+
+interactive-for-japanese.pyとgeneration_server.pyで共有する
+"""
+from collections import namedtuple
+import logging
+import math
+import os
+import tempfile
+
+import torch
+
+from fairseq import checkpoint_utils, options, tasks, utils
+from fairseq.data import encoders
+
+from generation_cache import GenerationCache
+
+
+logger = logging.getLogger('fairseq_cli.interactive')
+
+
+Batch = namedtuple('Batch', 'ids src_tokens src_lengths')
+
+# export_generator.pyが書き出すモデルのファイル名
+ARTIFACT_NAME = 'generator.pt'
+
+
+def make_batches(lines, args, task, max_positions, encode_fn, ignore_invalid_inputs=None):
+    tokens = [
+        task.source_dictionary.encode_line(
+            encode_fn(src_str), add_if_not_exist=False
+        ).long()
+        for src_str in lines
+    ]
+    lengths = [t.numel() for t in tokens]
+    # the inference dataset orders inputs by source length, so each batch holds inputs of
+    # similar length up to --max-tokens / --max-sentences; translate() restores the input order
+    itr = task.get_batch_iterator(
+        dataset=task.build_dataset_for_inference(tokens, lengths),
+        max_tokens=args.max_tokens,
+        max_sentences=args.max_sentences,
+        max_positions=max_positions,
+        ignore_invalid_inputs=(args.skip_invalid_size_inputs_valid_test
+                               if ignore_invalid_inputs is None else ignore_invalid_inputs),
+    ).next_epoch_itr(shuffle=False)
+    for batch in itr:
+        yield Batch(
+            ids=batch['id'],
+            src_tokens=batch['net_input']['src_tokens'], src_lengths=batch['net_input']['src_lengths'],
+        )
+
+
+class KeywordGenerator(object):
+    """
+    task, モデル, generator, encode_fnを用意し，キーワードの入力からツイートを生成する
+
+    modelsを渡すとcheckpointを読み込まずにそのモデルを使う(テスト用)．
+    cache(GenerationCache)を渡すと，generateはキャッシュにある入力をモデルに通さない．
+    --cpu-quantizeを指定するとmake_generation_fast_の後にLinear, LSTM, LSTMCellをint8に動的量子化する
+    """
+
+    def __init__(self, args, models=None, cache=None):
+        utils.import_user_module(args)
+        # スレッド数は並列の処理を始める前に決める
+        set_threads(args)
+        self.args = args
+        self.cache = cache
+        self.use_cuda = torch.cuda.is_available() and not args.cpu
+        if getattr(args, 'cpu_quantize', False):
+            if self.use_cuda:
+                raise ValueError('--cpu-quantize requires --cpu')
+            # 動的量子化はfp32の重みにしか使えない
+            if args.fp16:
+                raise ValueError('--cpu-quantize cannot be used with --fp16')
+
+        # Setup task, e.g., translation
+        self.task = tasks.setup_task(args)
+
+        # Load ensemble
+        if models is None and getattr(args, 'generator_artifact', None):
+            models = [load_artifact(args.generator_artifact)]
+        if models is None:
+            logger.info('loading model(s) from {}'.format(args.path))
+            models, _model_args = checkpoint_utils.load_model_ensemble(
+                args.path.split(os.pathsep),
+                arg_overrides=eval(args.model_overrides),
+                task=self.task,
+            )
+
+        # Set dictionaries
+        self.src_dict = self.task.source_dictionary
+        self.tgt_dict = self.task.target_dictionary
+
+        # Optimize ensemble for generation
+        for model in models:
+            model.make_generation_fast_(
+                beamable_mm_beam_size=None if args.no_beamable_mm else args.beam,
+                need_attn=args.print_alignment,
+            )
+            if args.fp16:
+                model.half()
+            if self.use_cuda:
+                model.cuda()
+        if getattr(args, 'cpu_quantize', False):
+            models = [quantize(model) for model in models]
+        self.models = models
+
+        # Initialize generator
+        self.generator = self.task.build_generator(models, args)
+
+        # Handle tokenization and BPE
+        self.tokenizer = encoders.build_tokenizer(args)
+        self.bpe = encoders.build_bpe(args)
+
+        # Load alignment dictionary for unknown word replacement
+        # (None if no unknown word replacement, empty if no path to align dictionary)
+        self.align_dict = utils.load_align_dict(args.replace_unk)
+
+        self.max_positions = utils.resolve_max_positions(
+            self.task.max_positions(),
+            *[model.max_positions() for model in models]
+        )
+
+    def encode_fn(self, x):
+        if self.tokenizer is not None:
+            x = self.tokenizer.encode(x)
+        if self.bpe is not None:
+            x = self.bpe.encode(x)
+        # キーワードを[SEP]ごとに文字で区切る
+        x = ' [SEP] '.join(
+            list(map(lambda x: ' '.join(list(x)), x.split('[SEP]'))))
+        return x.strip()
+
+    def decode_fn(self, x):
+        if self.bpe is not None:
+            x = self.bpe.decode(x)
+        if self.tokenizer is not None:
+            x = self.tokenizer.decode(x)
+        return x
+
+    def source_string(self, line):
+        """translateの入力をsrc_dict.stringで戻した文字列(辞書にない文字は<unk>)をモデルを通さずに返す"""
+        tokens = self.src_dict.encode_line(self.encode_fn(line), add_if_not_exist=False).long()
+        return self.src_dict.string(tokens, self.args.remove_bpe)
+
+    def translate(self, inputs, start_id=0, ignore_invalid_inputs=None):
+        """
+        入力の順に(id, src_tokens, hypos)のリストを返す
+
+        長すぎる入力は--skip-invalid-size-inputs-valid-test(ignore_invalid_inputsで上書きできる)を
+        付けると結果に含まれず，付けないと例外になる．idは入力の位置にstart_idを足したもの
+        """
+        results = []
+        for batch in make_batches(inputs, self.args, self.task, self.max_positions, self.encode_fn,
+                                  ignore_invalid_inputs):
+            src_tokens = batch.src_tokens
+            src_lengths = batch.src_lengths
+            if self.use_cuda:
+                src_tokens = src_tokens.cuda()
+                src_lengths = src_lengths.cuda()
+
+            sample = {
+                'net_input': {
+                    'src_tokens': src_tokens,
+                    'src_lengths': src_lengths,
+                },
+            }
+            translations = self.task.inference_step(self.generator, self.models, sample)
+            for i, (id, hypos) in enumerate(zip(batch.ids.tolist(), translations)):
+                src_tokens_i = utils.strip_pad(src_tokens[i], self.tgt_dict.pad())
+                results.append((start_id + id, src_tokens_i, hypos))
+
+        # sort output to match input order
+        return sorted(results, key=lambda x: x[0])
+
+    def generate(self, inputs):
+        """
+        入力ごとに上位nbest個の(スコア(底2), 生成したツイート)のリストを入力の順に返す
+
+        長すぎて生成できなかった入力はNoneになり，同時に渡した他の入力には影響しない
+        """
+        if self.cache is None:
+            return self._generate(inputs)
+        encoded = [self.encode_fn(line) for line in inputs]
+        # 同じ入力が複数あってもキャッシュを引くのと生成するのは1回だけにする
+        found, misses = {}, {}
+        for line, x in zip(inputs, encoded):
+            if x not in found:
+                found[x] = self.cache.get(x)
+                if found[x] is None:
+                    misses[x] = line
+        if misses:
+            for x, output in zip(misses, self._generate(list(misses.values()))):
+                if output is not None:
+                    self.cache.put(x, output)
+                found[x] = output
+        return [None if found[x] is None else [tuple(candidate) for candidate in found[x]]
+                for x in encoded]
+
+    def _generate(self, inputs):
+        # 長すぎる入力はtranslateの結果から除かれるので，位置ではなくidで入力と対応させる
+        outputs = [None] * len(inputs)
+        for id, src_tokens, hypos in self.translate(inputs, ignore_invalid_inputs=True):
+            src_str = self.src_dict.string(src_tokens, self.args.remove_bpe)
+            candidates = []
+            for hypo in hypos[:min(len(hypos), self.args.nbest)]:
+                _hypo_tokens, hypo_str, _alignment = utils.post_process_prediction(
+                    hypo_tokens=hypo['tokens'].int().cpu(),
+                    src_str=src_str,
+                    alignment=hypo['alignment'],
+                    align_dict=self.align_dict,
+                    tgt_dict=self.tgt_dict,
+                    remove_bpe=self.args.remove_bpe,
+                )
+                candidates.append((base2_score(hypo['score']), self.decode_fn(hypo_str)))
+            outputs[id] = candidates
+        return outputs
+
+
+def base2_score(score):
+    """hypoのスコアを底2に変換する．キャッシュから返す場合と同じ値になるようにfloatにして返す"""
+    return float(score / math.log(2))
+
+
+def quantize(model):
+    """Linear, LSTMとLSTMCell(fairseqのLSTMDecoderが使う)の重みをint8にする動的量子化(CPU用)"""
+    return torch.quantization.quantize_dynamic(
+        model, {torch.nn.Linear, torch.nn.LSTM, torch.nn.LSTMCell}, dtype=torch.qint8)
+
+
+def set_threads(args):
+    if getattr(args, 'intra_op_threads', None):
+        torch.set_num_threads(args.intra_op_threads)
+    # inter-opのスレッド数は並列の処理が始まった後には変えられないので，同じ値なら設定し直さない
+    if getattr(args, 'inter_op_threads', None) and torch.get_num_interop_threads() != args.inter_op_threads:
+        torch.set_num_interop_threads(args.inter_op_threads)
+
+
+def add_cpu_args(parser):
+    group = parser.add_argument_group('CPU')
+    group.add_argument('--cpu-quantize', action='store_true',
+                       help='apply dynamic int8 quantization to Linear, LSTM and LSTMCell layers (requires --cpu)')
+    group.add_argument('--intra-op-threads', type=int, default=None,
+                       help='number of threads used inside an operator (torch.set_num_threads)')
+    group.add_argument('--inter-op-threads', type=int, default=None,
+                       help='number of threads running operators in parallel (torch.set_num_interop_threads)')
+    return parser
+
+
+def load_artifact(artifact_dir):
+    """export_generator.pyで書き出したモデルを読み込む．mmapに対応したtorchではmmapで読む"""
+    path = os.path.join(artifact_dir, ARTIFACT_NAME)
+    logger.info('loading generator artifact from {}'.format(path))
+    try:
+        model = torch.load(path, map_location='cpu', mmap=True, weights_only=False)
+    except TypeError:
+        model = torch.load(path, map_location='cpu')
+    model.eval()
+    return model
+
+
+def model_path(args):
+    """生成に使うモデルのファイル(キャッシュのキーのハッシュ値に使う)"""
+    if getattr(args, 'generator_artifact', None):
+        return os.path.join(args.generator_artifact, ARTIFACT_NAME)
+    return args.path
+
+
+def add_artifact_args(parser):
+    group = parser.add_argument_group('Artifact')
+    group.add_argument('--generator-artifact', default=None,
+                       help='directory written by export_generator.py, used instead of --path')
+    return parser
+
+
+def build_tiny_generator(data_dir, generation_args=(), cache=None):
+    """
+    data_dirの辞書(dict.source.txt, dict.target.txt)から，ランダムに初期化した小さなLSTMの
+    KeywordGeneratorを作る(checkpoint無しのCPUでのテスト用)
+    """
+    parser = add_cpu_args(options.get_generation_parser(interactive=True))
+    args = options.parse_args_and_arch(parser, [
+        data_dir, '--source-lang', 'source', '--target-lang', 'target', '--cpu',
+        '--beam', '2', '--nbest', '2', '--max-len-b', '8', *generation_args])
+    model_parser = options.get_training_parser()
+    model_args = options.parse_args_and_arch(model_parser, [
+        data_dir, '--source-lang', 'source', '--target-lang', 'target', '--arch', 'lstm',
+        '--encoder-embed-dim', '8', '--encoder-hidden-size', '8', '--encoder-layers', '1',
+        '--decoder-embed-dim', '8', '--decoder-hidden-size', '8', '--decoder-out-embed-dim', '8',
+        '--decoder-layers', '1'])
+    model = tasks.setup_task(model_args).build_model(model_args)
+    model.eval()
+    return KeywordGenerator(args, models=[model], cache=cache)
+
+
+def write_tiny_dictionaries(data_dir, symbols="猫犬空雨晴です。"):
+    """build_tiny_generator用の辞書を書き出す"""
+    for lang in ("source", "target"):
+        with open(os.path.join(data_dir, "dict.{}.txt".format(lang)), 'w') as fout:
+            for symbol in list(symbols) + ["[SEP]"]:
+                print("{} 1".format(symbol), file=fout)
+
+
+def test_cpu_quantize():
+    with tempfile.TemporaryDirectory() as data_dir:
+        write_tiny_dictionaries(data_dir)
+        torch.manual_seed(1)
+        num_threads = torch.get_num_threads()
+        try:
+            keyword_generator = build_tiny_generator(data_dir, ['--cpu-quantize', '--intra-op-threads', '1'])
+            assert torch.get_num_threads() == 1
+        finally:
+            # 他のテストのスレッド数を変えない
+            torch.set_num_threads(num_threads)
+        model = keyword_generator.models[0]
+        assert isinstance(model.encoder.lstm, torch.nn.quantized.dynamic.LSTM)
+        assert isinstance(model.decoder.layers[0], torch.nn.quantized.dynamic.LSTMCell)
+        outputs = keyword_generator.generate(["猫", "犬[SEP]雨"])
+        assert [len(output) for output in outputs] == [2, 2], outputs
+        try:
+            build_tiny_generator(data_dir, ['--cpu-quantize', '--fp16'])
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('--cpu-quantize with --fp16 must be rejected')
+
+
+def test_cached_output():
+    with tempfile.TemporaryDirectory() as data_dir:
+        write_tiny_dictionaries(data_dir)
+        torch.manual_seed(1)
+        keyword_generator = build_tiny_generator(data_dir)
+        # 鳥は辞書にないので<unk>になる
+        queries = ["猫", "鳥[SEP]雨"]
+        for query, (_, src_tokens, _) in zip(queries, keyword_generator.translate(queries)):
+            assert keyword_generator.source_string(query) == \
+                keyword_generator.src_dict.string(src_tokens, keyword_generator.args.remove_bpe)
+        assert "<unk>" in keyword_generator.source_string("鳥")
+        expected = keyword_generator.generate(queries)
+        keyword_generator.cache = GenerationCache("tiny-lstm")
+        assert keyword_generator.generate(queries) == expected
+        assert keyword_generator.generate(queries) == expected
+        assert keyword_generator.cache.info()["hits"] == len(queries)
@@ -3,18 +3,219 @@
 import re
 import string
 import unicodedata
+from collections import Counter, OrderedDict
+from contextlib import ExitStack, contextmanager
+from functools import lru_cache
+import os
+import time
 
 import MeCab
 
+from parallel import iter_chunks
+
+
+# 名前の付いたCJK統合漢字，ひらがな，カタカナは全て第3面(U+3FFFF)までにある
+_MAX_NAMED_CODEPOINT = 0x40000
+
+# unicodedata.nameに各文字列を含む文字の範囲．
+# 全ての文字の名前を調べると1プロセスあたり0.3秒ほどかかるので，フィルタで使うものは調べた結果を持っておく．
+# Unicodeの版が違うと範囲も変わる(Python 3.12以降はCJK統合漢字拡張Hなどが増える)ので，その場合は調べ直す
+_NAMED_RANGES_VERSION = "14.0.0"
+_NAMED_RANGES = {
+    "CJK UNIFIED": ((0x3400, 0x4DBF), (0x4E00, 0x9FFF), (0x1F210, 0x1F212), (0x1F214, 0x1F23B),
+                    (0x1F240, 0x1F248), (0x20000, 0x2A6DF), (0x2A700, 0x2B738), (0x2B740, 0x2B81D),
+                    (0x2B820, 0x2CEA1), (0x2CEB0, 0x2EBE0), (0x30000, 0x3134A)),
+    "HIRAGANA": ((0x3041, 0x3096), (0x3099, 0x30A0), (0x30FC, 0x30FC), (0xFF70, 0xFF70),
+                 (0x1B001, 0x1B001), (0x1B11F, 0x1B11F), (0x1B150, 0x1B152), (0x1F200, 0x1F200)),
+    "KATAKANA": ((0x3099, 0x309C), (0x30A0, 0x30FF), (0x31F0, 0x31FF), (0x32D0, 0x32FE),
+                 (0xFF65, 0xFF9F), (0x1AFF0, 0x1AFF3), (0x1AFF5, 0x1AFFB), (0x1AFFD, 0x1AFFE),
+                 (0x1B000, 0x1B000), (0x1B120, 0x1B122), (0x1B164, 0x1B167), (0x1F201, 0x1F202),
+                 (0x1F213, 0x1F213)),
+    "HIRAGANA LETTER": ((0x3041, 0x3096), (0x1B001, 0x1B001), (0x1B11F, 0x1B11F), (0x1B150, 0x1B152)),
+    "KATAKANA LETTER": ((0x30A1, 0x30FA), (0x31F0, 0x31FF), (0xFF66, 0xFF6F), (0xFF71, 0xFF9D),
+                        (0x1AFF0, 0x1AFF3), (0x1AFF5, 0x1AFFB), (0x1AFFD, 0x1AFFE), (0x1B000, 0x1B000),
+                        (0x1B120, 0x1B122), (0x1B164, 0x1B167)),
+}
+
+
+def _scan_named_ranges(name):
+    ranges = []
+    for cp in range(_MAX_NAMED_CODEPOINT):
+        if name in unicodedata.name(chr(cp), ""):
+            if ranges and ranges[-1][1] == cp - 1:
+                ranges[-1][1] = cp
+            else:
+                ranges.append([cp, cp])
+    return [tuple(r) for r in ranges]
+
+
+@lru_cache(maxsize=None)
+def unicode_name_reg(names: tuple, exclude: str = ""):
+    """unicodedata.nameがnamesのいずれかを含む文字(excludeの文字は除く)にマッチする正規表現を返す
+
+    文字の範囲から文字クラスを作るので，1文字ずつunicodedata.nameを呼ぶ代わりに1回のsearchで判定できる．
+    _NAMED_RANGESにない名前の場合か，unicodedataの版が_NAMED_RANGES_VERSIONと違う場合だけ全ての文字の名前を調べる
+    """
+    use_table = unicodedata.unidata_version == _NAMED_RANGES_VERSION
+    ranges = []
+    for name in names:
+        ranges.extend(_NAMED_RANGES[name] if use_table and name in _NAMED_RANGES else _scan_named_ranges(name))
+    # 重なる範囲をまとめる
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    # excludeの文字で範囲を分ける
+    for cp in sorted(set(map(ord, exclude))):
+        for i, (start, end) in enumerate(merged):
+            if start <= cp <= end:
+                merged[i:i + 1] = [r for r in ([start, cp - 1], [cp + 1, end]) if r[0] <= r[1]]
+                break
+    char_class = "".join(re.escape(chr(start)) if start == end else
+                         "{}-{}".format(re.escape(chr(start)), re.escape(chr(end)))
+                         for start, end in merged)
+    return re.compile("[{}]".format(char_class))
+
+
+_taggers = {}
+
+
+def get_tagger(option: str = "") -> MeCab.Tagger:
+    """プロセスごとにoptionごとのTaggerを1つだけ作って使い回す
+
+    辞書の読み込みに時間がかかるので最初に使うときまで作らない．
+    fork前に作ったTaggerを子プロセスで共有しないようにプロセスIDをキーに含める
+    """
+    key = (os.getpid(), option)
+    tagger = _taggers.get(key)
+    if tagger is None:
+        tagger = _taggers[key] = MeCab.Tagger(option)
+    return tagger
+
+
+class Analysis(object):
+    """MeCabで1回解析した結果．トークンや品詞はここから作る"""
+
+    def __init__(self, surfaces, features):
+        self.surfaces = surfaces
+        self.features = features
+        self._tokens = None
+        self._pos = None
+
+    @property
+    def tokens(self):
+        """MeCab.Tagger("-Owakati").parse(text).split()と同じトークン列"""
+        if self._tokens is None:
+            self._tokens = " ".join(self.surfaces).split()
+        return self._tokens
+
+    @property
+    def pos(self):
+        """各形態素の(品詞, 品詞細分類1)"""
+        if self._pos is None:
+            self._pos = [tuple(feature.split(",", 2)[:2])
+                         for feature in self.features]
+        return self._pos
+
+
+class Analyzer(object):
+    """テキストごとにMeCabを1回だけ呼び，結果を複数のフィルタやキーワード抽出で共有する
+
+    直近に解析したmax_recent個のテキストの結果を保持する．
+    1つのchainを複数のフィルタで調べる間はここから結果を返す．
+    cache_sizeを指定すると，重複の多いテキスト(RTやコピペ)のために
+    最大cache_size個の結果をLRUで保持し，ヒット数とミス数を数える．
+    この場合は直近の結果もLRUから返すので，ヒット数はMeCabを呼ばずに済んだ回数になる
+    """
+
+    def __init__(self, tagger=None, max_recent=32, cache_size=0):
+        self._tagger = tagger
+        self._max_recent = max_recent
+        self._recent = {}
+        self._kept = {}
+        self._cache_size = cache_size
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, text: str) -> Analysis:
+        analysis = self._kept.get(text)
+        if analysis is not None:
+            return analysis
+        if self._cache_size > 0:
+            return self._cached_analyze(text)
+        analysis = self._recent.get(text)
+        if analysis is None:
+            if len(self._recent) >= self._max_recent:
+                self._recent.clear()
+            analysis = self.analyze(text)
+            self._recent[text] = analysis
+        return analysis
+
+    def _cached_analyze(self, text: str) -> Analysis:
+        analysis = self._cache.get(text)
+        if analysis is not None:
+            self._cache.move_to_end(text)
+            self.hits += 1
+            return analysis
+        self.misses += 1
+        analysis = self.analyze(text)
+        self._cache[text] = analysis
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return analysis
+
+    @contextmanager
+    def keep(self, texts):
+        """with文の間はtextsの解析結果を保持して返す．
+
+        1つのchainやバッチを複数のフィルタで調べる間，max_recentを超えても解析し直さないようにする
+        """
+        kept = self._kept
+        self._kept = dict(kept)
+        for text in texts:
+            if text not in self._kept:
+                self._kept[text] = self(text)
+        try:
+            yield
+        finally:
+            self._kept = kept
+
+    @property
+    def tagger(self):
+        if self._tagger is None:
+            self._tagger = get_tagger()
+        return self._tagger
+
+    def cache_info(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses,
+                "maxsize": self._cache_size, "currsize": len(self._cache)}
+
+    def analyze(self, text: str) -> Analysis:
+        surfaces, features = [], []
+        node = self.tagger.parseToNode(text)
+        while node:
+            if node.stat not in (MeCab.MECAB_BOS_NODE, MeCab.MECAB_EOS_NODE):
+                surfaces.append(node.surface)
+                features.append(node.feature)
+            node = node.next
+        return Analysis(surfaces, features)
+
 
 class ChainFilter(object):
-    def __init__(self, comment=None, normalization=True, max_hold=1000, joint=False):
+    # 判定にAnalyzer(MeCab)の結果を使うか
+    uses_analyzer = False
+
+    def __init__(self, comment=None, normalization=True, max_hold=1000, joint=False, analyzer=None):
         # value
         self.comment = comment
         self.filtered_chains = []
+        self.rejected_counts = Counter()
         self._max_hold = max_hold
-        self.mecab = MeCab.Tagger("-Owakati")
-        self.tokenizer = lambda text: self.mecab.parse(text).split()
+        self.analyzer = analyzer if analyzer is not None else Analyzer()
+        self.tokenizer = lambda text: self.analyzer(text).tokens
 
         # option
         self._can_normalize = normalization
@@ -22,49 +223,84 @@ class ChainFilter(object):
 
         # regular expression
         self._userid_reg = re.compile(r"@[a-zA-Z0-9_]{1,15}")
-        self._head_userid_reg = re.compile(
-            r"^@[a-zA-Z0-9_]{1,15} (.*?)$", re.DOTALL)
+        self._head_userids_reg = re.compile(r"(?:@[a-zA-Z0-9_]{1,15} )+")
         self._url_reg = re.compile(r"https?://[\w/:%#\$&\?\(\)~\.=\+\-]+")
-        self._normalization_reg = re.compile(r"([wWＷｗ。．.、，,・･…〜~\-！？!?])\1+")
-
-        # test
-        self._filtering_test()
+        # URLの置換と記号の繰り返しの除去を1回のsubで行う
+        self._normalization_reg = re.compile(
+            r"(https?://[\w/:%#\$&\?\(\)~\.=\+\-]+)|([wWＷｗ。．.、，,・･…〜~\-！？!?])\2+")
+        self._normalization_table = str.maketrans(
+            {" ": None, "　": None, "\t": None, "\n": "。"})
 
     def __call__(self, text_chain: [str]) -> [str]:
         """Returns True if the condition is met, False otherwise"""
-        if self._is_joint:
-            if self.is_pass(text_chain):
-                return text_chain
-        else:
-            text_chain = [self._username_filter(text) for text in text_chain]
-            if self.is_pass(text_chain):
-                if self._can_normalize:
-                    text_chain = [self._normalization(
-                        text).strip("\n") for text in text_chain]
-                else:
-                    text_chain = [text.strip("\n") for text in text_chain]
-
-                return text_chain
+        text_chain = self._prepare(text_chain)
+        if self.is_pass(text_chain):
+            return self._finalize(text_chain)
 
     def is_pass(self, text_chain: [str]) -> bool:
         """"Returns True if the condition is met, False otherwise"""
         raise NotImplementedError
 
+    def pass_mask_batch(self, text_chains: [[str]]) -> [bool]:
+        """
+        複数のchainを判定し，条件を満たすchainにTrueを立てたリストを返す．
+        除外した数はrejected_countsに数える．まとめて判定できるフィルタはこれを上書きする
+        """
+        mask = [self.is_pass(text_chain) for text_chain in text_chains]
+        self.rejected_counts[self.__class__.__name__] += mask.count(False)
+        return mask
+
+    def filter_batch(self, text_chains, chunk_size=1000):
+        """
+        chainをchunk_sizeずつまとめて判定し，条件を満たすchainを__call__と同じ形に整えて返す
+
+        除外したchainは保持せず，rejected_countsにフィルタごとの数だけを記録する
+        """
+        for chunk in iter_chunks(text_chains, chunk_size):
+            chunk = [self._prepare(text_chain) for text_chain in chunk]
+            for text_chain, ok in zip(chunk, self.pass_mask_batch(chunk)):
+                if ok:
+                    yield self._finalize(text_chain)
+
+    def _prepare(self, text_chain: [str]) -> [str]:
+        if self._is_joint:
+            return text_chain
+        return [self._username_filter(text) for text in text_chain]
+
+    def _finalize(self, text_chain: [str]) -> [str]:
+        if self._is_joint:
+            return text_chain
+        if self._can_normalize:
+            return [self._normalization(text).strip("\n") for text in text_chain]
+        return [text.strip("\n") for text in text_chain]
+
     def _username_filter(self, text):
-        m = self._head_userid_reg.search(text)
-        if m:
-            return self._username_filter(m.group(1))
-        else:
+        """先頭に続く@ユーザ名を取り除く"""
+        m = self._head_userids_reg.match(text)
+        if not m:
             return text
+        n_user = m.group().count("@")
+        text = text[m.end():]
+        # 以前の再帰による実装はユーザ名を1つ除くごとに末尾の改行を1つ落としていたので合わせる
+        n_newline = len(text) - len(text.rstrip("\n"))
+        return text[:len(text) - min(n_user, n_newline)]
 
     def _normalization(self, text):
-        text = self._url_reg.sub("<URL>", text)
-        text = self._normalization_reg.sub(r"\1", text)
-        text = text.replace(" ", "")
-        text = text.replace("　", "")
-        text = text.replace("\t", "")
-        text = text.replace("\n", "。")
-        return text
+        text = self._normalization_reg.sub(self._normalize_match, text)
+        return text.translate(self._normalization_table)
+
+    @staticmethod
+    def _normalize_match(m):
+        return "<URL>" if m.group(1) else m.group(2)
+
+    def verify(self):
+        """正規化と各フィルタの動作確認を行う．生成のたびには走らせないので必要なときに呼ぶ"""
+        self._filtering_test()
+        self.filtering_test()
+        return self
+
+    def filtering_test(self):
+        """各フィルタの動作確認．フィルタごとに上書きする"""
 
     def _filtering_test(self):
         text1 = "@Test_2019NLP @amaretto01 @chair_69_BREAK フィルタリング成功した? https://github.com/"
@@ -96,11 +332,11 @@ class NoFilter(ChainFilter):
 class CharLengthFilter(ChainFilter):
     """Filtering based on character length."""
 
-    def __init__(self, max_len=30, min_len=5, normalization=True, max_hold=1000, joint=False):
+    def __init__(self, max_len=30, min_len=5, normalization=True, max_hold=1000, joint=False, analyzer=None):
         comment = "Filter for using only {} to {} letter reply chains".format(
             min_len, max_len)
         super(CharLengthFilter, self).__init__(
-            comment, normalization, max_hold, joint)
+            comment, normalization, max_hold, joint, analyzer)
         self.max_len = max_len
         self.min_len = min_len
 
@@ -115,13 +351,14 @@ class CharLengthFilter(ChainFilter):
 class InabaFilter(ChainFilter):
     """'14, 稲葉通将+, Twitterを用いた非タスク指向型対話システムのための発話候補文獲得"""
 
-    def __init__(self, normalization=True, max_hold=1000, joint=False):
+    uses_analyzer = True
+
+    def __init__(self, normalization=True, max_hold=1000, joint=False, analyzer=None):
         comment = "1. URLを含むものは除去\n2. 単語が6~29\n3. ユーザ名を含まないもの"
         super(InabaFilter, self).__init__(
-            comment, normalization, max_hold, joint)
+            comment, normalization, max_hold, joint, analyzer)
         self.max_len = 29
         self.min_len = 6
-        self.filtering_test()
 
     def is_pass(self, text_chain: [str]):
         """"Returns True if the condition is met, False otherwise"""
@@ -162,7 +399,7 @@ class InabaFilter(ChainFilter):
 class BasicFilter(ChainFilter):
     """基本的なものを除去"""
 
-    def __init__(self, normalization=True, max_hold=1000, joint=False):
+    def __init__(self, normalization=True, max_hold=1000, joint=False, analyzer=None):
         comment = """ <基本的なフィルタリング>
         1. URLを含むものは除去
         2. ユーザ名を含むものは除去
@@ -170,9 +407,8 @@ class BasicFilter(ChainFilter):
         4. 日本語を含まないものは除外
         """
         super(BasicFilter, self).__init__(
-            comment, normalization, max_hold, joint)
+            comment, normalization, max_hold, joint, analyzer)
         self._japanese_names = ["CJK UNIFIED", "HIRAGANA", "KATAKANA"]
-        self.filtering_test()
 
     def is_pass(self, text_chain: [str]):
         """"Returns True if the condition is met, False otherwise"""
@@ -193,13 +429,7 @@ class BasicFilter(ChainFilter):
             return True
 
     def _is_japanese(self, text):
-        for ch in text:
-            try:
-                name = unicodedata.name(ch)
-                if any(n in name for n in self._japanese_names):
-                    return True
-            except:
-                pass
+        return unicode_name_reg(tuple(self._japanese_names)).search(text) is not None
 
     def _has_url(self, text):
         if self._url_reg.search(text):
@@ -220,9 +450,7 @@ class BasicFilter(ChainFilter):
         false_chain = [[text2], [text3], [text4], [text5], [
             text1, text2], [text6, text3], [text1, text6, text4]]
         for chain in true_chain:
-            if not self.is_pass(chain):
-                import ipdb
-                ipdb.set_trace()
+            assert self.is_pass(chain), chain
         for chain in false_chain:
             assert not self.is_pass(chain)
 
@@ -230,13 +458,14 @@ class BasicFilter(ChainFilter):
 class WordLenFilter(ChainFilter):
     """単語の文字数でフィルタリング"""
 
-    def __init__(self, min_len=6, max_len=29, normalization=True, max_hold=1000, joint=False):
+    uses_analyzer = True
+
+    def __init__(self, min_len=6, max_len=29, normalization=True, max_hold=1000, joint=False, analyzer=None):
         comment = "単語が{}~{}".format(min_len, max_len)
         super(WordLenFilter, self).__init__(
-            comment, normalization, max_hold, joint)
+            comment, normalization, max_hold, joint, analyzer)
         self.min_len = min_len
         self.max_len = max_len
-        self.filtering_test()
 
     def is_pass(self, text_chain: [str]):
         """"Returns True if the condition is met, False otherwise"""
@@ -263,11 +492,12 @@ class WordLenFilter(ChainFilter):
 class EmoticonFilter(ChainFilter):
     """顔文字を除去"""
 
-    def __init__(self, normalization=True, max_hold=1000, joint=False):
+    def __init__(self, normalization=True, max_hold=1000, joint=False, analyzer=None):
         comment = "記号やアルファベットが3文字以上続く&2つ以上の種類から構成されるものは除去"
         super(EmoticonFilter, self).__init__(
-            comment, normalization, max_hold, joint)
-        self._candidate_reg = re.compile(r"[\W_a-zA-Z]+")
+            comment, normalization, max_hold, joint, analyzer)
+        # 記号の部分は3文字以上でないと顔文字にならないので，短い候補は最初から除く
+        self._candidate_reg = re.compile(r"[\W_a-zA-Z]{3,}")
         self._punctuation_reg = re.compile(r"[\W_]+")
         self._repeat = re.compile(r"([。．.、，,・･…〜~\-！？!?])\1+")
         self._alphabet = string.ascii_lowercase + string.ascii_uppercase
@@ -276,7 +506,8 @@ class EmoticonFilter(ChainFilter):
                                 "HIRAGANA LETTER", "KATAKANA LETTER"]
         self._face_letter = ["T", "o", "O", "ロ", "口",
                              "ロ", "ﾛ", "つ", "っ", "灬", "ノ", "ﾉ", "c", "C"]
-        self.filtering_test()
+        self._japanese_char_key = (
+            tuple(self._japanese_names), "".join(self._face_letter))
 
     def is_pass(self, text_chain: [str]):
         """"Returns True if the condition is met, False otherwise"""
@@ -298,13 +529,7 @@ class EmoticonFilter(ChainFilter):
                 return True
 
     def _has_japanese_char(self, text):
-        for ch in text:
-            try:
-                name = unicodedata.name(ch)
-                if any(n in name for n in self._japanese_names) and not any(c == ch for c in self._face_letter):
-                    return True
-            except:
-                pass
+        return unicode_name_reg(*self._japanese_char_key).search(text) is not None
 
     def filtering_test(self):
         text1 = "Twitterやってる？"
@@ -335,51 +560,180 @@ class EmoticonFilter(ChainFilter):
 class JaccardFilter(ChainFilter):
     """Jaccard similarityを元にフィルタリング"""
 
-    def __init__(self, threshold=0.5, normalization=True, max_hold=1000, joint=False):
+    uses_analyzer = True
+
+    def __init__(self, threshold=0.5, normalization=True, max_hold=1000, joint=False, analyzer=None):
         comment = "1. Jaccard similarity が 閾値 {} を超えたら除外\n" \
                   "2. len(set(words)) / len(words) が 0.5を下回ったら除外".format(str(threshold))
         super(JaccardFilter, self).__init__(
-            comment, normalization, max_hold, joint)
+            comment, normalization, max_hold, joint, analyzer)
         self.threshold = threshold
 
     def is_pass(self, text_chain: [str]):
         """"Returns True if the condition is met, False otherwise"""
-        for i in range(len(text_chain)):
-            words = self.tokenizer(text_chain[i])
-            if len(set(words)) / len(words) < 0.5:
+        # 1つ前のテキストのsetを使い回し，トークナイズは各テキスト1回にする
+        prev = None
+        for text in text_chain:
+            words = self.tokenizer(text)
+            current = set(words)
+            if len(current) / len(words) < 0.5:
                 return False
-            if i != 0:
-                set1 = set(self.tokenizer(text_chain[i - 1]))
-                set2 = set(words)
-                score = len(set1 & set2) / len(set1 | set2)
+            if prev is not None:
+                score = len(prev & current) / len(prev | current)
                 if score >= self.threshold:
                     return False
+            prev = current
         return True
 
 
 class HeuristicFilter(ChainFilter):
-    """Heuristic filter"""
+    """Heuristic filter
 
-    def __init__(self, normalization=True, max_hold=1000, joint=False):
+    各フィルタの処理時間と除外率を数え，BasicFilterの後は除外1件あたりの時間が短いフィルタから
+    先に実行するようにreorder_interval個のchainごとに並べ替える(adaptive=Trueの場合)．
+    全てのフィルタを通ったchainだけが残るので，順番を変えても結果は変わらない．
+    MeCabの解析はAnalyzerを使う最初のフィルタの前にまとめて行い，どのフィルタの時間にも含めない
+    """
+
+    def __init__(self, normalization=True, max_hold=1000, joint=False, analyzer=None,
+                 adaptive=True, reorder_interval=1000):
         comment = "BasicFilter, EmoticonFilter, WordLenFilter, JaccardFilterを行うFiltering"
         super(HeuristicFilter, self).__init__(
-            comment, normalization, max_hold, joint)
-        self.basic = BasicFilter(joint=True)
-        self.emoticon = EmoticonFilter(joint=True)
-        self.wordlen = WordLenFilter(joint=True)
-        self.jaccard = JaccardFilter(joint=True)
+            comment, normalization, max_hold, joint, analyzer)
+        # 同じテキストの解析結果を全てのフィルタで共有する
+        self.basic = BasicFilter(joint=True, analyzer=self.analyzer)
+        self.emoticon = EmoticonFilter(joint=True, analyzer=self.analyzer)
+        self.wordlen = WordLenFilter(joint=True, analyzer=self.analyzer)
+        self.jaccard = JaccardFilter(joint=True, analyzer=self.analyzer)
         self.filters = [self.basic, self.emoticon, self.wordlen, self.jaccard]
 
+        self._adaptive = adaptive
+        self._reorder_interval = reorder_interval
+        self._n_chains = 0
+        self._next_reorder = reorder_interval
+        self.filter_stats = {filtering.__class__.__name__: {"calls": 0, "rejected": 0, "seconds": 0.0}
+                             for filtering in self.filters}
+        self.analysis_stats = {"texts": 0, "seconds": 0.0}
+
     def is_pass(self, text_chain: [str]):
         """"Returns True if the condition is met, False otherwise"""
-        for filtering in self.filters:
-            text_chain = filtering(text_chain)
-            if not text_chain:
-                if len(self.filtered_chains) < self._max_hold:
-                    self.filtered_chains.append(
-                        [filtering.__class__.__name__, text_chain])
-                break
+        with ExitStack() as stack:
+            analyzed = False
+            for filtering in self.filters:
+                if filtering.uses_analyzer and not analyzed:
+                    self._keep_analyses(stack, [text_chain])
+                    analyzed = True
+                start = time.perf_counter()
+                text_chain = filtering(text_chain)
+                self._record(filtering, 1, 0 if text_chain else 1,
+                             time.perf_counter() - start)
+                if not text_chain:
+                    if len(self.filtered_chains) < self._max_hold:
+                        self.filtered_chains.append(
+                            [filtering.__class__.__name__, text_chain])
+                    break
+        self._count_chains(1)
         if text_chain is not None:
             return True
         else:
             return False
+
+    def pass_mask_batch(self, text_chains: [[str]]) -> [bool]:
+        """"各フィルタを残っているchainだけにまとめて適用し，除外した数をフィルタごとに数える"""
+        mask = [True] * len(text_chains)
+        alive = list(range(len(text_chains)))
+        with ExitStack() as stack:
+            analyzed = False
+            for filtering in self.filters:
+                if not alive:
+                    break
+                if filtering.uses_analyzer and not analyzed:
+                    self._keep_analyses(stack, [text_chains[i] for i in alive])
+                    analyzed = True
+                start = time.perf_counter()
+                sub_mask = filtering.pass_mask_batch([text_chains[i] for i in alive])
+                rejected = [i for i, ok in zip(alive, sub_mask) if not ok]
+                self._record(filtering, len(alive), len(rejected),
+                             time.perf_counter() - start)
+                self.rejected_counts[filtering.__class__.__name__] += len(rejected)
+                for i in rejected:
+                    mask[i] = False
+                alive = [i for i, ok in zip(alive, sub_mask) if ok]
+        self._count_chains(len(text_chains))
+        return mask
+
+    def verify(self):
+        super(HeuristicFilter, self).verify()
+        for filtering in self.filters:
+            filtering.verify()
+        return self
+
+    def _keep_analyses(self, stack, text_chains):
+        """残っているchainのテキストを解析してstackが閉じるまで保持し，解析の時間を別に数える"""
+        texts = [text for text_chain in text_chains for text in text_chain]
+        start = time.perf_counter()
+        stack.enter_context(self.analyzer.keep(texts))
+        self.analysis_stats["texts"] += len(texts)
+        self.analysis_stats["seconds"] += time.perf_counter() - start
+
+    def _record(self, filtering, calls, rejected, seconds):
+        stats = self.filter_stats[filtering.__class__.__name__]
+        stats["calls"] += calls
+        stats["rejected"] += rejected
+        stats["seconds"] += seconds
+
+    def _count_chains(self, n):
+        self._n_chains += n
+        if self._adaptive and self._n_chains >= self._next_reorder:
+            self._next_reorder = self._n_chains + self._reorder_interval
+            self.reorder()
+
+    def reorder(self):
+        """除外1件あたりの処理時間(MeCabの解析は含まない)が短い順にフィルタを並べ替える
+
+        BasicFilterは日本語を含まないテキスト(トークンが無いテキスト)を先に除き，
+        JaccardFilterなどはそれを前提にしているので常に先頭に置く
+        """
+        def cost_per_rejection(filtering):
+            stats = self.filter_stats[filtering.__class__.__name__]
+            return stats["seconds"] / (stats["rejected"] + 1)
+        self.filters[1:] = sorted(self.filters[1:], key=cost_per_rejection)
+
+    def summary(self) -> str:
+        """フィルタごとの処理時間と除外率を現在の実行順で返す"""
+        lines = []
+        for filtering in self.filters:
+            name = filtering.__class__.__name__
+            stats = self.filter_stats[name]
+            calls = max(stats["calls"], 1)
+            lines.append("{}: calls={} rejected={} ({:.1%}) {:.1f}us/chain".format(
+                name, stats["calls"], stats["rejected"], stats["rejected"] / calls,
+                stats["seconds"] / calls * 1e6))
+        texts = max(self.analysis_stats["texts"], 1)
+        lines.append("Analyzer: texts={} {:.1f}us/text".format(
+            self.analysis_stats["texts"], self.analysis_stats["seconds"] / texts * 1e6))
+        return "\n".join(lines)
+
+
+def test_filters():
+    # 辞書を読み込めずにトークン化が空になると判定の確認にならないので先に確かめる
+    assert Analyzer()("猫が好き").tokens == ["猫", "が", "好き"]
+    for filter_class in [CharLengthFilter, InabaFilter, BasicFilter, WordLenFilter,
+                         EmoticonFilter, JaccardFilter, HeuristicFilter]:
+        filter_class().verify()
+
+
+def test_named_ranges():
+    # _NAMED_RANGESは_NAMED_RANGES_VERSIONのunicodedataで調べた結果と一致する
+    if unicodedata.unidata_version != _NAMED_RANGES_VERSION:
+        return
+    for name, ranges in _NAMED_RANGES.items():
+        assert _scan_named_ranges(name) == list(ranges), name
+
+
+def test_analyzer_cache():
+    analyzer = Analyzer(cache_size=2)
+    for text in ["猫が好き", "猫が好き", "犬が好き", "猫が好き", "空が青い", "犬が好き"]:
+        assert analyzer(text).tokens[1:] in (["が", "好き"], ["が", "青い"])
+    # 2回目の猫と3回目の猫はMeCabを呼ばない．犬は空を入れたときに追い出されている
+    assert analyzer.cache_info() == {"hits": 2, "misses": 4, "maxsize": 2, "currsize": 2}
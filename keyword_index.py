@@ -0,0 +1,140 @@
+'''
+preprocess.pyの出力からキーワードごとの出現ツイート数(document frequency)の表を作る
+usage : python keyword_index.py -i [preprocess.pyの出力 ...] -o [出力の接頭辞] --workers 4
+        python keyword_index.py --merge -i [索引の接頭辞 ...] -o [出力の接頭辞]
+
+[接頭辞].vocab (1行に1キーワード，行番号がID)，[接頭辞].df.npy (IDごとの出現ツイート数)，
+[接頭辞].json (ツイート数と語彙数)を書き出す．
+入力ファイルごとの索引は並列に作ってまとめるので，別々に作った索引も--mergeで1つにできる
+'''
+import argparse
+import json
+import logging
+import math
+from multiprocessing import Pool
+from os import path
+
+import numpy as np
+from logzero import logger
+
+from extract_viral_tweet import read_lines
+
+logger.setLevel(logging.INFO)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-i', '--inputs', nargs='+', help='output files of preprocess.py (index prefixes with --merge)')
+    parser.add_argument(
+        '-o', '--output', type=path.abspath, help='output prefix')
+    parser.add_argument(
+        '--merge', action='store_true', help='merge indexes built separately instead of reading tweets')
+    parser.add_argument(
+        '--workers', type=int, default=1, help='number of input files indexed in parallel')
+    args = parser.parse_args()
+    return args
+
+
+def count_document_frequency(input_path):
+    """
+    キーワードごとの出現ツイート数のdict(初出順)とツイート数を返す
+    """
+    df = {}
+    n_docs = 0
+    for line in read_lines(input_path):
+        for keyword in dict.fromkeys(json.loads(line)["keywords"]):
+            df[keyword] = df.get(keyword, 0) + 1
+        n_docs += 1
+    return df, n_docs
+
+
+def write_index(prefix, vocab, counts, n_docs):
+    with open(prefix + ".vocab", 'w') as fout:
+        for keyword in vocab:
+            print(keyword, file=fout)
+    np.save(prefix + ".df.npy", np.asarray(counts, dtype=np.int64))
+    with open(prefix + ".json", 'w') as fout:
+        json.dump({"n_docs": n_docs, "vocab_size": len(vocab)}, fout)
+
+
+def read_vocab(prefix):
+    with open(prefix + ".vocab", 'r') as fin:
+        return [line.rstrip("\n") for line in fin]
+
+
+class KeywordIndex(object):
+    """
+    キーワードの出現ツイート数の表．出現ツイート数はメモリマップで読み，キーワードごとにO(1)で引ける
+    """
+
+    def __init__(self, prefix):
+        with open(prefix + ".json", 'r') as fin:
+            self.n_docs = json.load(fin)["n_docs"]
+        self.vocab = {keyword: i for i, keyword in enumerate(read_vocab(prefix))}
+        self.counts = np.load(prefix + ".df.npy", mmap_mode='r')
+
+    def __len__(self):
+        return len(self.vocab)
+
+    def __contains__(self, keyword):
+        return keyword in self.vocab
+
+    def df(self, keyword) -> int:
+        i = self.vocab.get(keyword)
+        return 0 if i is None else int(self.counts[i])
+
+    def idf(self, keyword) -> float:
+        """log(ツイート数 / 出現ツイート数)．索引に無いキーワードは1回出現したものとして扱う"""
+        return math.log(self.n_docs / max(self.df(keyword), 1))
+
+    def is_stopword(self, keyword, max_df_ratio) -> bool:
+        """ツイートのmax_df_ratioより多くに出現するキーワードならTrue"""
+        return self.df(keyword) > max_df_ratio * self.n_docs
+
+
+def build_index(input_paths, output, workers=1):
+    if workers > 1:
+        with Pool(workers) as pool:
+            shards = pool.map(count_document_frequency, input_paths)
+    else:
+        shards = list(map(count_document_frequency, input_paths))
+    total, n_docs = {}, 0
+    # 入力の順にまとめるので，workersによらず同じ索引になる
+    for df, n in shards:
+        for keyword, count in df.items():
+            total[keyword] = total.get(keyword, 0) + count
+        n_docs += n
+    write_index(output, list(total), list(total.values()), n_docs)
+    return len(total), n_docs
+
+
+def merge_indexes(prefixes, output):
+    vocab = {}
+    for prefix in prefixes:
+        for keyword in read_vocab(prefix):
+            vocab.setdefault(keyword, len(vocab))
+    counts = np.zeros(len(vocab), dtype=np.int64)
+    n_docs = 0
+    for prefix in prefixes:
+        ids = np.fromiter((vocab[keyword] for keyword in read_vocab(prefix)), dtype=np.int64)
+        np.add.at(counts, ids, np.load(prefix + ".df.npy", mmap_mode='r'))
+        with open(prefix + ".json", 'r') as fin:
+            n_docs += json.load(fin)["n_docs"]
+    write_index(output, list(vocab), counts, n_docs)
+    return len(vocab), n_docs
+
+
+def main():
+    args = parse_args()
+    logger.info(args)
+
+    if args.merge:
+        vocab_size, n_docs = merge_indexes(args.inputs, args.output)
+    else:
+        vocab_size, n_docs = build_index(args.inputs, args.output, args.workers)
+    logger.info(f"tweets: {n_docs}\nkeywords: {vocab_size}")
+
+
+if __name__ == '__main__':
+    main()
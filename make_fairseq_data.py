@@ -1,5 +1,13 @@
 '''
-説明
+preprocess.pyの出力からseq2seqの入力(キーワード)と出力(ツイート)を作る
+usage : python make_fairseq_data.py -i [preprocess.pyの出力] --output_dir [出力ディレクトリ] --workers 4
+
+--output_dirを指定すると，ツイートのハッシュ値でtrain/dev/testに分け，
+{train,dev,test}.source (キーワード)と{train,dev,test}.target (ツイート)の6ファイルを直接書き出す．
+--destdirを指定すると，同じ分割でfairseq-preprocessの出力(辞書と.bin/.idx)を直接書き出す．
+--num_variantsでK(>1)を指定すると，ツイートごとにK通りのキーワードの組を*.source.variants.{bin,idx}にも書き出す．
+-oを指定した場合は`キーワード\tツイート`の1ファイルを書き出す．
+キーワードの選び方は--seedと行番号から決まる乱数で決めるので，workersによらず同じ出力になる
 '''
 import argparse
 import logzero
@@ -9,10 +17,28 @@ from os import path
 from typing import List
 import random
 import json
+import math
+import hashlib
+import os
+from collections import defaultdict
+from contextlib import ExitStack
+
+from extract_viral_tweet import read_lines
+from fairseq_mmap import FairseqDataWriter
+from keyword_index import KeywordIndex, count_document_frequency
+from parallel import iter_chunks, map_chunks
 
 logger.setLevel(logging.DEBUG)
 
 SEP = "[SEP]"
+SPLITS = ("train", "dev", "test")
+
+# init_workerでプロセスごとに設定する
+seed = 1
+idf = None
+keyword_index = None
+max_df_ratio = 1.0
+num_variants = 1
 
 
 def parse_args():
@@ -20,30 +46,157 @@ def parse_args():
     parser.add_argument(
         '-i', '--input', type=path.abspath, help='input file path')
     parser.add_argument(
-        '-o', '--output', type=path.abspath, help='output file path')
+        '-o', '--output', type=path.abspath, default=None, help='output file path (keywords\ttweet)')
+    parser.add_argument(
+        '--output_dir', type=path.abspath, default=None,
+        help='output directory of {train,dev,test}.{source,target}')
+    parser.add_argument(
+        '--destdir', type=path.abspath, default=None,
+        help='output directory of fairseq dictionaries and mmap datasets (same as fairseq-preprocess --destdir)')
+    parser.add_argument(
+        '--num_variants', type=int, default=1,
+        help='number of keyword subsets written per tweet (requires --destdir if more than 1)')
+    parser.add_argument(
+        '--dev_ratio', type=float, default=0.01, help='ratio of tweets used for dev')
+    parser.add_argument(
+        '--test_ratio', type=float, default=0.01, help='ratio of tweets used for test')
+    parser.add_argument(
+        '--workers', type=int, default=1, help='number of worker processes')
+    parser.add_argument(
+        '--chunk_size', type=int, default=1000, help='number of tweets sent to a worker at once')
     parser.add_argument(
         '--seed',  type=int, default=1, help='seed')
+    parser.add_argument(
+        '--idf', action='store_true',
+        help='use the keywords with the highest IDF over the input instead of a random sample')
+    parser.add_argument(
+        '--keyword_index', type=path.abspath, default=None,
+        help='prefix of an index built by keyword_index.py, used instead of rescanning the input')
+    parser.add_argument(
+        '--max_df_ratio', type=float, default=1.0,
+        help='drop keywords that appear in more than this ratio of tweets (stopwords)')
     args = parser.parse_args()
+    if [args.output, args.output_dir, args.destdir].count(None) != 2:
+        parser.error("specify exactly one of --output, --output_dir and --destdir")
+    if args.num_variants > 1 and args.destdir is None:
+        parser.error("--num_variants requires --destdir")
+    if args.max_df_ratio < 1.0 and args.keyword_index is None:
+        parser.error("--max_df_ratio requires --keyword_index")
     return args
 
 
+def compute_idf(path) -> dict:
+    """
+    入力(preprocess.pyの出力)全体でのキーワードのIDF(log(ツイート数 / 出現ツイート数))を返す
+    """
+    df, n_docs = count_document_frequency(path)
+    return {keyword: math.log(n_docs / count) for keyword, count in df.items()}
+
+
+def select_keywords(keywords: List[str], key_nums: int, idf=None, rng=random) -> List[str]:
+    """
+    key_nums個のキーワードを選ぶ．idf(キーワードのIDFを返す関数)を渡すとIDFの大きい(珍しい)ものから選ぶ
+    """
+    if idf is None:
+        return rng.sample(keywords, key_nums)
+    # sortedは安定なので，IDFが同じキーワードは出現順になる
+    return sorted(keywords, key=lambda keyword: -idf(keyword))[:key_nums]
+
+
+def split_of(tweet: str, dev_ratio: float, test_ratio: float) -> str:
+    """
+    ツイートのハッシュ値で分割先を決める．同じツイートは必ず同じ分割先になる
+    """
+    bucket = int.from_bytes(hashlib.md5(tweet.encode()).digest()[:8], "little") / 2 ** 64
+    if bucket < test_ratio:
+        return "test"
+    if bucket < test_ratio + dev_ratio:
+        return "dev"
+    return "train"
+
+
+def test_split_of():
+    tweets = [str(i) for i in range(10000)]
+    splits = [split_of(tweet, 0.1, 0.2) for tweet in tweets]
+    assert splits == [split_of(tweet, 0.1, 0.2) for tweet in tweets]
+    assert 800 < splits.count("dev") < 1200 and 1800 < splits.count("test") < 2200
+    assert all(split_of(tweet, 0.0, 0.0) == "train" for tweet in tweets)
+
+
+def init_worker(args, idf_table=None):
+    '''
+    プロセスごとにシード，キーワードの索引とIDFを設定する
+    '''
+    global seed, idf, keyword_index, max_df_ratio, num_variants
+    seed = args.seed
+    num_variants = args.num_variants
+    max_df_ratio = args.max_df_ratio
+    keyword_index = KeywordIndex(args.keyword_index) if args.keyword_index else None
+    idf = None
+    if args.idf:
+        idf = keyword_index.idf if keyword_index is not None else idf_table.__getitem__
+
+
+def make_pair(index: int, line) -> (List[str], str):
+    '''
+    index行目のツイートから(num_variants通りのキーワード, ツイート)を作る．
+    1つ目のキーワードはnum_variantsによらず同じになる
+    '''
+    # 行ごとに乱数を作るので，どのプロセスで処理しても同じキーワードが選ばれる
+    rng = random.Random(f"{seed}-{index}")
+    line = json.loads(line)
+    keywords = line["keywords"]
+    if keyword_index is not None and max_df_ratio < 1.0:
+        keywords = [keyword for keyword in keywords
+                    if not keyword_index.is_stopword(keyword, max_df_ratio)]
+    sources = []
+    for _ in range(num_variants):
+        # 使用するキーワードを選択
+        key_nums = min(rng.randint(1, 5), len(keywords))
+        sources.append(f" {SEP} ".join(select_keywords(keywords, key_nums, idf, rng)))
+    return sources, line["tweet"]
+
+
+def make_pairs(chunk):
+    return [make_pair(index, line) for index, line in chunk]
+
+
 def main():
     args = parse_args()
     logger.info(args)
 
-    # シードを固定
-    random.seed(args.seed)
-
-    with open(args.input, 'r') as fin,  open(f"{args.output}", 'w') as fout:
-        for line in fin:
-            line = json.loads(line)
-            # 使用するキーワードを選択
-            key_nums = min(random.randint(1, 5), len(line["keywords"]))
-            keywords = f" {SEP} ".join(
-                random.sample(line["keywords"], key_nums))
-
-            print(f"{keywords}\t{line['tweet']}", file=fout)
-    return
+    idf_table = compute_idf(args.input) if args.idf and not args.keyword_index else None
+    chunks = iter_chunks(enumerate(read_lines(args.input)), args.chunk_size)
+    cnt_dic = defaultdict(int)
+    with ExitStack() as stack:
+        if args.output_dir:
+            os.makedirs(args.output_dir, exist_ok=True)
+            files = {(split, side): stack.enter_context(
+                open(path.join(args.output_dir, f"{split}.{side}"), 'w'))
+                for split in SPLITS for side in ("source", "target")}
+        elif args.destdir:
+            writer = FairseqDataWriter(args.destdir, num_variants=args.num_variants)
+        else:
+            fout = stack.enter_context(open(args.output, 'w'))
+        # キーワードの選び方は行番号から決まる乱数で，分割先はツイートのハッシュ値で決まるので，
+        # どのworkerが処理しても各行の出力は同じになる
+        results = map_chunks(stack, make_pairs, chunks, args.workers, init_worker, (args, idf_table))
+        for pairs in results:
+            for sources, target in pairs:
+                if args.output_dir or args.destdir:
+                    split = split_of(target, args.dev_ratio, args.test_ratio)
+                    if args.destdir:
+                        writer.add(split, sources, target)
+                    else:
+                        print(sources[0], file=files[split, "source"])
+                        print(target, file=files[split, "target"])
+                    cnt_dic[split] += 1
+                else:
+                    print(f"{sources[0]}\t{target}", file=fout)
+                    cnt_dic["train"] += 1
+    if args.destdir:
+        writer.close()
+    logger.info(f"train: {cnt_dic['train']}\ndev: {cnt_dic['dev']}\ntest: {cnt_dic['test']}")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,33 @@
+'''
+    チャンクに分けて処理するための小さな共通処理．
+    MeCabやpyarrowなどを読み込まないので，どのスクリプトやworkerからでも安く読み込める
+'''
+from multiprocessing import Pool
+
+
+def iter_chunks(iterable, chunk_size):
+    '''
+    iterableをchunk_size個ずつのリストにまとめて返す(最後のリストは短いこともある)
+    '''
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def map_chunks(stack, func, chunks, workers, initializer, initargs=()):
+    '''
+    chunksの各チャンクにfuncを適用した結果を入力の順に返す
+
+    workersが2以上ならinitializerで初期化したPoolで並列に処理し，Poolはstack(ExitStack)が閉じるときに終了する．
+    Pool.imapは入力の順に結果を返すので，出力はworkersによらず1プロセスの場合と同じになる
+    '''
+    if workers > 1:
+        pool = stack.enter_context(Pool(workers, initializer=initializer, initargs=initargs))
+        return pool.imap(func, chunks)
+    initializer(*initargs)
+    return map(func, chunks)
@@ -8,19 +8,27 @@ from logzero import logger
 import logging
 from os import path
 from typing import List
-from filtering_type import EmoticonFilter
+from filtering_type import Analyzer, EmoticonFilter
+from extract_viral_tweet import COLUMNAR_SUFFIXES, read_lines, read_records
+from parallel import iter_chunks, map_chunks
 import json
-import MeCab
 from collections import defaultdict
+from contextlib import ExitStack
 import re
 
 logger.setLevel(logging.INFO)
 
 
-mecabTagger = MeCab.Tagger("-Ochasen")
+# init_workerでプロセスごとに作り直す
+analyzer = Analyzer()
+emoticon_filter = None
+tokenizer = None
 
 hiragana = re.compile('[ぁ-ゟ]+')
 
+FULL_WIDTH2HALF_WIDTH = str.maketrans(
+    {chr(0xFF01 + i): chr(0x21 + i) for i in range(94)})
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -31,6 +39,13 @@ def parse_args():
     parser.add_argument(
         "--tokenizer", type=str, default="char", help="tokenizer. Select mecab if you want to use mecab"
     )
+    parser.add_argument(
+        '--workers', type=int, default=1, help='number of worker processes')
+    parser.add_argument(
+        '--chunk_size', type=int, default=1000, help='number of tweets sent to a worker at once')
+    parser.add_argument(
+        '--cache_size', type=int, default=0,
+        help='number of MeCab analyses kept in an LRU cache per worker (0: disabled)')
     args = parser.parse_args()
     return args
 
@@ -40,8 +55,7 @@ def full_width2half_width(text: str) -> str:
     全角文字を半角文字に変換
     '''
     # 変換
-    text = text.translate(str.maketrans(
-        {chr(0xFF01 + i): chr(0x21 + i) for i in range(94)}))
+    text = text.translate(FULL_WIDTH2HALF_WIDTH)
     return text
 
 
@@ -67,6 +81,45 @@ def test_is_char_length():
         assert is_char_length(text) == answer
 
 
+class KeywordExtractor(object):
+    """
+    ツイートから代名詞以外の名詞(ひらがなだけのものは除く)をキーワードとして出現順に抽出する
+
+    表層形と素性の組ごとに判定結果を保持するので，同じ形態素の素性を何度も分割しない
+    """
+
+    def __init__(self, analyzer=None, max_cache=100000):
+        self.analyzer = analyzer if analyzer is not None else Analyzer()
+        self._max_cache = max_cache
+        self._decisions = {}
+
+    def __call__(self, text: str) -> List[str]:
+        analysis = self.analyzer(text)
+        keywords = [surface for surface, feature in zip(analysis.surfaces, analysis.features)
+                    if self.is_keyword(surface, feature)]
+        # 重複を除いても出現順を保つ
+        return list(dict.fromkeys(keywords))
+
+    def extract_batch(self, texts) -> List[List[str]]:
+        return [self(text) for text in texts]
+
+    def is_keyword(self, surface: str, feature: str) -> bool:
+        key = (surface, feature)
+        decision = self._decisions.get(key)
+        if decision is None:
+            if len(self._decisions) >= self._max_cache:
+                self._decisions.clear()
+            # 品詞と品詞細分類1だけを見るので，素性は先頭の2つだけ分割する
+            hinshi = feature.split(",", 2)
+            decision = (hinshi[0] == "名詞" and hinshi[1] != "代名詞"
+                        and not hiragana.fullmatch(surface))
+            self._decisions[key] = decision
+        return decision
+
+
+keyword_extractor = KeywordExtractor(analyzer)
+
+
 def get_keywords(text: str) -> List[str]:
     """
     ツイートからキーワードを抽出
@@ -79,65 +132,112 @@ def get_keywords(text: str) -> List[str]:
     Returns
     -------
     keywords : List[str]
-        キーワードのリスト
+        キーワードのリスト(出現順)
     """
-    keywords = []
-    node = mecabTagger.parseToNode(text)
-    while node:
-        word = node.surface
-        hinshi = node.feature.split(",")
-        if hinshi[0] == "名詞" and hinshi[1] != "代名詞" and not hiragana.fullmatch(word):
-            keywords.append(word)
-        node = node.next
-    keywords = list(set(keywords))
-    return keywords
+    return keyword_extractor(text)
 
 
 def test_get_keywords():
-    queries = ["私のご飯", 'あれとこれ', 'ももとすもも']
-    answers = [["ご飯"], [], []]
+    queries = ["私のご飯", 'あれとこれ', 'ももとすもも', '猫と犬と猫']
+    answers = [["ご飯"], [], [], ["猫", "犬"]]
     for q, a in zip(queries, answers):
         q = get_keywords(q)
-        assert set(q) == set(a), f"{q},{a}"
+        assert q == a, f"{q},{a}"
+
+
+def read_input(path):
+    '''
+    jsonl(.gz, .zstも可)の場合は各行(bytes)を，列指向のファイルの場合はtext列だけを読み込んだdictを返す
+    '''
+    if path.endswith(COLUMNAR_SUFFIXES):
+        return read_records(path, ["text"])
+    return read_lines(path)
+
+
+def init_worker(tokenizer_name: str, cache_size: int = 0):
+    '''
+    プロセスごとにMeCabのAnalyzer，KeywordExtractorとEmoticonFilterを作る．
+    MeCabのTaggerは最初に解析するときにプロセスごとに1つだけ作られる
+    '''
+    global analyzer, keyword_extractor, emoticon_filter, tokenizer
+    analyzer = Analyzer(cache_size=cache_size)
+    keyword_extractor = KeywordExtractor(analyzer)
+    emoticon_filter = EmoticonFilter(analyzer=analyzer)
+    if tokenizer_name == 'mecab':
+        # キーワード抽出と同じ解析結果を使う
+        def tokenizer(text): return ' '.join(analyzer(text).tokens)
+    else:
+        def tokenizer(text): return ' '.join(list(text))
+
+
+def preprocess_line(line):
+    '''
+    1ツイート分の前処理を行う
+
+    Returns
+    -------
+    (kind, output) : (str, str)
+        kindは"ok", "emoji", "more_than_140", "error"のいずれか．
+        outputは書き出す行で，kindが"ok"以外の場合はNone
+    '''
+    try:
+        if not isinstance(line, dict):
+            line = json.loads(line)
+        text = line["text"]
+        # 顔文字を含むツイートは除外
+        if emoticon_filter._has_emoticon(text):
+            return "emoji", None
+        if not is_char_length(text):
+            logger.debug(f"this tweet is exceed 140 chars. \n{text}")
+            return "more_than_140", None
+        # user nameを削除
+        text = emoticon_filter._username_filter(text)
+        # スペースなどを置換
+        text = emoticon_filter._normalization(text)
+
+        keywords = list(map(tokenizer, get_keywords(text)))
+        text = tokenizer(text)
+
+        return "ok", json.dumps({"keywords": keywords, "tweet": text}, ensure_ascii=False)
+    except:
+        logger.error(f"this data is skipped {line}")
+        return "error", None
+
+
+def preprocess_chunk(lines):
+    '''
+    複数のツイートの前処理を行い，結果とこの間のMeCabのキャッシュのヒット数，ミス数を返す
+    '''
+    hits, misses = analyzer.hits, analyzer.misses
+    results = [preprocess_line(line) for line in lines]
+    return results, analyzer.hits - hits, analyzer.misses - misses
 
 
 def main():
     args = parse_args()
     logger.info(args)
 
-    def tokenizer(text): return self.mecab.parse(text).split(
-    ) if args.tokenizer == 'mecab' else ' '.join(list(text))
-
-    filter = EmoticonFilter()
+    chunks = iter_chunks(read_input(args.input), args.chunk_size)
     cnt_dic = defaultdict(int)
-    with open(args.input, 'r') as fin, open(args.output, 'w') as fout:
-        for line in fin:
-            try:
-                line = json.loads(line)
-                text = line["text"]
-                # 顔文字を含むツイートは除外
-                if filter._has_emoticon(text):
-                    cnt_dic['emoji'] += 1
-                    continue
-                if not is_char_length(text):
-                    logger.debug(f"this tweet is exceed 140 chars. \n{text}")
-                    cnt_dic["more_than_140"] += 1
-                    continue
-                # user nameを削除
-                text = filter._username_filter(text)
-                # スペースなどを置換
-                text = filter._normalization(text)
-
-                keywords = list(map(tokenizer, get_keywords(text)))
-                text = tokenizer(text)
-
-                print(json.dumps(
-                    {"keywords": keywords, "tweet": text}, ensure_ascii=False), file=fout)
-            except:
-                cnt_dic['error'] += 1
-                logger.error(f"this data is skipped {line}")
+    with ExitStack() as stack:
+        fout = stack.enter_context(open(args.output, 'w'))
+        results = map_chunks(stack, preprocess_chunk, chunks, args.workers,
+                             init_worker, (args.tokenizer, args.cache_size))
+        for chunk, hits, misses in results:
+            cnt_dic['cache_hit'] += hits
+            cnt_dic['cache_miss'] += misses
+            for kind, output in chunk:
+                if kind == "ok":
+                    print(output, file=fout)
+                else:
+                    cnt_dic[kind] += 1
     logger.info(
         f"emoji tweet: {cnt_dic['emoji']}\nmore than 140 tweet:{cnt_dic['more_than_140']}\nerror:{cnt_dic['error']}")
+    if args.cache_size > 0:
+        lookups = cnt_dic['cache_hit'] + cnt_dic['cache_miss']
+        logger.info(
+            f"mecab cache hit: {cnt_dic['cache_hit']}\nmecab cache miss:{cnt_dic['cache_miss']}\n"
+            f"hit rate:{cnt_dic['cache_hit'] / max(lookups, 1):.3f}")
 
 
 if __name__ == '__main__':